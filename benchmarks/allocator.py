@@ -0,0 +1,28 @@
+"""Benchmark of `allocate` with hundreds of clients.
+
+Run from the repository root with `python -m benchmarks.allocator`."""
+
+import random
+import timeit
+
+from helpers.allocator import allocate
+
+
+
+def main() -> None:
+    rng = random.Random(1)
+
+    for count in (10, 100, 500, 1000):
+        weights = [rng.randint(0, 50) for _ in range(count)]
+        floors = [rng.choice([0, rng.random() * 5]) for _ in range(count)]
+        ceilings = [rng.choice([None, floor + rng.random() * 50]) for floor in floors]
+        total = count * 10
+
+        runs = 200
+        seconds = min(timeit.repeat(lambda: allocate(total, weights, floors, ceilings), number=runs, repeat=5)) / runs
+        print(f"{count:>5} clients: {seconds * 1e3:8.3f} ms per allocation")
+
+
+
+if __name__ == "__main__":
+    main()
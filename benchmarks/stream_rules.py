@@ -0,0 +1,126 @@
+"""Benchmark of the stream rules, against `process_session` as it was before them.
+
+Run from the repository root with `python -m benchmarks.stream_rules`."""
+
+import ipaddress
+import random
+import timeit
+
+from helpers.config import IgnoreStreamConfig, StreamRuleConfig
+from helpers.log_loader import logger
+from helpers.stream_rules import StreamPolicy
+from modules.media_server import BaseServer, session_identity
+from tests.servers import load_server
+
+
+
+def baseline_process_session(self: BaseServer, bandwidth: int, paused: bool, ip_address: str, session_id: str, title: str, player_id: str = "", media_id: str = "") -> int:
+    "`BaseServer.process_session` before the stream rules, which parsed `ip_networks` for every session."
+
+    if paused and self._server_config.ignore_streams.paused_after != -1:
+
+        if session_id not in self._paused_since:
+            self._paused_since[session_id] = int(self._module._clock.time())
+            logger.debug(f"{self._logger_prefix} {title}:{session_id} is paused, noted time")
+
+        elif int(self._module._clock.time()) - self._paused_since[session_id] > self._server_config.ignore_streams.paused_after:
+            logger.debug(f"{self._logger_prefix} Removing {title}:{session_id} from count, paused for too long")
+            return 0
+
+    elif self._server_config.ignore_streams.paused_after != -1:
+        if session_id in self._paused_since:
+            logger.debug(f"{self._logger_prefix} {title}:{session_id} is no longer paused, removing from paused dict")
+            del self._paused_since[session_id]
+
+    local_ip: bool = False
+
+    if self._server_config.ignore_streams.local:
+        if ip_address == "lan" or ipaddress.ip_address(ip_address).is_private:
+            local_ip = True
+
+    if self._server_config.ignore_streams.ip_networks:
+        ip = ipaddress.ip_address(ip_address)
+        networks = (ipaddress.ip_network(network) for network in self._server_config.ignore_streams.ip_networks)
+        if any(ip in network for network in networks):
+            local_ip = True
+
+
+    if local_ip:
+        logger.debug(f"{self._logger_prefix} Ignoring local stream {title}:{session_id} ({ip_address})")
+        return 0
+
+    logger.debug(f"{self._logger_prefix} Adding {bandwidth} to count for {title}:{session_id}")
+
+    identity = session_identity(self._server_config, session_id, ip_address, player_id, media_id)
+    self._sessions[identity] = max(bandwidth, self._sessions.get(identity, 0))
+
+    return bandwidth
+
+
+def random_rules(rng: random.Random, count: int) -> list[StreamRuleConfig]:
+    return [
+        StreamRuleConfig(
+            action=rng.choice(["ignore", "cap", "multiply"]),
+            value=rng.random() * 10,
+            server_type=rng.choice([None, "plex", "jellyfin"]),
+            user=rng.choice([None, f"user{rng.randrange(50)}"]),
+            player=rng.choice([None, None, f"player{rng.randrange(50)}"]),
+            library=rng.choice([None, None, f"library{rng.randrange(10)}"]),
+            transcode=rng.choice([None, None, True, False]),
+        )
+        for _ in range(count)
+    ]
+
+
+def random_session(rng: random.Random) -> tuple[str, str, str, str, str, bool]:
+    return (
+        f"{rng.randint(1, 99)}.{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(256)}",
+        rng.choice(["plex", "jellyfin", "emby"]),
+        f"User{rng.randrange(60)} ",
+        f"Player{rng.randrange(60)}",
+        f"library{rng.randrange(12)}",
+        rng.random() < 0.5,
+    )
+
+
+def per_session(function, sessions: list) -> float:
+    "The fastest time per session of 5 runs, in us. Every run sees the same sessions, like every poll of a server does."
+    runs = 20
+    return min(timeit.repeat(lambda: [function(i, *session) for i, session in enumerate(sessions)], number=runs, repeat=5)) / runs / len(sessions) * 1e6
+
+
+def main() -> None:
+    rng = random.Random(1)
+    sessions = [random_session(rng) for _ in range(1000)]
+
+    for name, ignore_streams in (
+        ("local", IgnoreStreamConfig(local=True, ip_networks=None, paused_after=60)),
+        ("local and ip_networks", IgnoreStreamConfig(local=True, ip_networks=("100.64.0.0/10", "fd00::/8"), paused_after=60)),
+    ):
+        print(f"ignore_streams: {name}")
+
+        server = load_server([], ignore_streams=ignore_streams)
+        baseline = per_session(
+            lambda i, ip_address, server_type, user, player, library, transcode: baseline_process_session(server, 8000, False, ip_address, str(i), "title"),
+            sessions
+        )
+        print(f"  before stream rules:  {baseline:6.2f} us per session")
+
+        for count in (0, 10, 100, 1000, 5000):
+            rules = random_rules(rng, count)
+            policy = StreamPolicy(rules, "Mbit")
+            server = load_server(rules, ignore_streams=ignore_streams)
+
+            decide = per_session(lambda i, ip_address, *session: policy.decide(*session), sessions)
+            process = per_session(
+                lambda i, ip_address, server_type, user, player, library, transcode: server.process_session(8000, False, ip_address, str(i), "title", user=user, player=player, library=library, transcode=transcode),
+                sessions
+            )
+            print(f"  {count:>5} rules:          {process:6.2f} us per session ({decide:5.2f} us deciding, {process / baseline:4.0%} of before)")
+
+        print()
+
+
+
+if __name__ == "__main__":
+    main()
@@ -44,6 +44,15 @@ class qBittorrentClient:
         )
     
 
+    def get_transferred_bytes(self) -> tuple[int, int]:
+        "Get the bytes uploaded and downloaded since the client started. Returns a tuple of `(upload, download)`."
+
+        logger.debug(f"<qbit|{self._client_config.url}> Getting transfer info")
+
+        transfer_info = self._client.transfer_info()
+        return transfer_info.up_info_data, transfer_info.dl_info_data
+    
+
     def set_upload_speed(self, speed: Union[int, float]) -> None:
         "Set the upload speed limit for the client, in config units."
         
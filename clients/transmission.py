@@ -6,15 +6,31 @@ from transmission_rpc.error import (
 )
 from typing import Union
 import urllib.parse
+import threading
+import traceback
 
 from helpers.config import SpeedrrConfig, ClientConfig
 from helpers.log_loader import logger
 from helpers.bit_convert import bit_conv
+from helpers.history import history
+from helpers.clock import Clock, system_clock
+
+# Transmission only returns torrents active in the last 60 seconds for recently-active queries
+RECENTLY_ACTIVE_SECONDS = 60
+
+# How often the rate table is refreshed, well within RECENTLY_ACTIVE_SECONDS so the recently-active query is the normal case
+REFRESH_INTERVAL = 15
 
 class TransmissionClient:
-    def __init__(self, config: SpeedrrConfig, config_client: ClientConfig) -> None:
+    def __init__(self, config: SpeedrrConfig, config_client: ClientConfig, clock: Clock = system_clock) -> None:
         self._client_config = config_client
         self._config = config
+        self._clock = clock
+
+        # Upload and download rate of every torrent, in B/s, kept up to date with recently-active queries
+        self._torrent_rates: dict[int, tuple[int, int]] = {}
+        self._last_refresh: float = -RECENTLY_ACTIVE_SECONDS
+        self._rates_lock = threading.Lock()
 
 
         # Gets hostname, port, and path from url and checks if values are sensible
@@ -55,13 +71,82 @@ class TransmissionClient:
 
         logger.debug(f"<trans|{self._client_config.url}> Connected to Transmission")
 
+    def refresh_torrent_rates(self) -> None:
+        "Update the rate of every torrent. Only recently active torrents are fetched, unless the last refresh is too old for that."
+
+        fields = ["id", "rateUpload", "rateDownload"]
+
+        with self._rates_lock:
+            now = self._clock.time()
+
+            if now - self._last_refresh >= RECENTLY_ACTIVE_SECONDS:
+                logger.debug(f"<trans|{self._client_config.url}> Getting all torrent rates")
+
+                torrents = self._client.get_torrents(arguments=fields)
+                self._torrent_rates = {torrent.id: (torrent.rate_upload, torrent.rate_download) for torrent in torrents}
+
+            else:
+                logger.debug(f"<trans|{self._client_config.url}> Getting recently active torrent rates")
+
+                torrents, removed_ids = self._client.get_recently_active_torrents(arguments=fields)
+                for torrent in torrents:
+                    self._torrent_rates[torrent.id] = (torrent.rate_upload, torrent.rate_download)
+                for torrent_id in removed_ids:
+                    self._torrent_rates.pop(torrent_id, None)
+
+            self._last_refresh = now
+
+
+    def run(self) -> None:
+        "Keep the rate table up to date on a daemon thread, and record the measured rates in the history."
+        thread = threading.Thread(target=self.loop)
+        thread.daemon = True
+        thread.start()
+
+
+    def loop(self) -> None:
+        while True:
+            try:
+                self.refresh_torrent_rates()
+            except Exception:
+                logger.error(f"<trans|{self._client_config.url}> Error refreshing torrent rates:\n" + traceback.format_exc())
+            else:
+                upload, download = self.get_transfer_rates()
+                history.record(f"client.{self._client_config.url}.measured_upload", upload, self._clock.time())
+                history.record(f"client.{self._client_config.url}.measured_download", download, self._clock.time())
+
+            self._clock.sleep(REFRESH_INTERVAL)
+
+
     def get_active_torrent_count(self) -> int:
         "Get the number of torrents that are currently downloading or uploading."
 
         logger.debug(f"<trans|{self._client_config.url}> Getting active torrent count")
 
-        sessionStats = self._client.session_stats()
-        return sessionStats.active_torrent_count
+        # Normally already fresh from `loop`
+        if self._clock.time() - self._last_refresh >= REFRESH_INTERVAL:
+            self.refresh_torrent_rates()
+
+        with self._rates_lock:
+            return sum(1 for rate_upload, rate_download in self._torrent_rates.values() if rate_upload > 0 or rate_download > 0)
+
+
+    def get_transfer_rates(self) -> tuple[float, float]:
+        "Get the current upload and download rate of every torrent combined, in config units, as of the last refresh. Returns a tuple of `(upload, download)`."
+
+        with self._rates_lock:
+            return (
+                bit_conv(sum(rates[0] for rates in self._torrent_rates.values()), 'B', self._config.units),
+                bit_conv(sum(rates[1] for rates in self._torrent_rates.values()), 'B', self._config.units),
+            )
+
+    def get_transferred_bytes(self) -> tuple[int, int]:
+        "Get the bytes uploaded and downloaded since the client started. Returns a tuple of `(upload, download)`."
+
+        logger.debug(f"<trans|{self._client_config.url}> Getting session stats")
+
+        current_stats = self._client.session_stats().current_stats
+        return current_stats.uploaded_bytes, current_stats.downloaded_bytes
 
     def set_upload_speed(self, speed: Union[int, float]) -> None:
         "Set the upload speed limit for the client, in config units."
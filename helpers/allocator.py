@@ -0,0 +1,82 @@
+import math
+from typing import List, Optional, Sequence
+
+
+
+def allocate(
+    total: float,
+    weights: Sequence[float],
+    floors: Optional[Sequence[Optional[float]]] = None,
+    ceilings: Optional[Sequence[Optional[float]]] = None,
+) -> List[float]:
+    """Split `total` between clients using weighted max-min fairness, in O(n log n).
+
+    Every client gets `level * weight`, clamped between its floor and ceiling (`None` means no limit),
+    where `level` is picked so the shares add up to `total`. Bandwidth a client can't use because of
+    its ceiling is shared between the rest, by weight.
+
+    If the floors add up to more than `total`, they are scaled down to fit.
+    If the ceilings add up to less than `total`, every weighted client gets its ceiling.
+    Clients without any weight always get their floor."""
+
+    count = len(weights)
+    floor_values = [(floor or 0) for floor in floors] if floors else [0.0] * count
+    ceiling_values = [
+        math.inf if ceiling is None else max(ceiling, floor_values[i])
+        for i, ceiling in enumerate(ceilings)
+    ] if ceilings else [math.inf] * count
+
+    sum_floors = sum(floor_values)
+    if sum_floors >= total:
+        if sum_floors == 0:
+            return [0.0] * count
+        return [floor * total / sum_floors for floor in floor_values]
+
+    if sum(ceiling_values) <= total:
+        return [
+            ceiling if weight > 0 else floor
+            for weight, floor, ceiling in zip(weights, floor_values, ceiling_values)
+        ]
+
+    # f(level) = sum(clamp(level * weight, floor, ceiling)) is piecewise linear, and only changes slope
+    # where a client starts rising above its floor, or reaches its ceiling.
+    breakpoints: List[tuple[float, float, float]] = []
+    for weight, floor, ceiling in zip(weights, floor_values, ceiling_values):
+        if weight <= 0:
+            continue
+
+        breakpoints.append((floor / weight, weight, -floor))
+        if ceiling != math.inf:
+            breakpoints.append((ceiling / weight, -weight, ceiling))
+
+    breakpoints.sort()
+
+    base = sum_floors
+    slope = 0.0
+    # Stays infinite if every weighted client reaches its ceiling before `total` is used up
+    level = math.inf
+
+    for point, slope_change, base_change in breakpoints:
+        if slope > 0 and base + slope * point >= total:
+            level = (total - base) / slope
+            break
+
+        base += base_change
+        slope += slope_change
+
+    else:
+        if slope > 0:
+            level = (total - base) / slope
+
+    def share(weight: float) -> float:
+        # `(total - base) / slope * weight` doesn't round-trip, e.g. a lone client of weight 11 would get a bit more than `total`
+        if level == math.inf:
+            return math.inf
+        if weight == slope:
+            return total - base
+        return min((total - base) * weight / slope, total)
+
+    return [
+        min(max(share(weight), floor), ceiling) if weight > 0 else floor
+        for weight, floor, ceiling in zip(weights, floor_values, ceiling_values)
+    ]
@@ -34,4 +34,59 @@ def load_args() -> argparse.Namespace:
         type=int,
         default=os.environ.get('SPEEDRR_LOG_FILE_LEVEL', logging.WARNING)
     )
+    argparser.add_argument(
+        '--query_history',
+        dest='query_history',
+        metavar='SERIES',
+        help='Print the history of a series from a running instance and exit, use "list" to list all series',
+        default=None
+    )
+    argparser.add_argument(
+        '--at',
+        dest='at',
+        help='Used with --query_history, only print the value at this time (unix timestamp, ISO datetime or HH:MM today)',
+        default=None
+    )
+    return argparser.parse_args()
+
+
+
+def load_simulation_args() -> argparse.Namespace:
+    argparser = argparse.ArgumentParser(description='Replay a trace of streams and torrent activity through speedrr, on a virtual clock')
+    argparser.add_argument(
+        '--config_path',
+        dest='config',
+        help='Path to the config file',
+        type=lambda x: is_valid_file(argparser, x),
+        default=os.environ.get('SPEEDRR_CONFIG')
+    )
+    argparser.add_argument(
+        '--trace',
+        dest='trace',
+        help='Path to the trace file to replay',
+        type=lambda x: is_valid_file(argparser, x),
+        default=None
+    )
+    argparser.add_argument(
+        '--synthetic',
+        dest='synthetic',
+        metavar='SECONDS',
+        help='Generate a random trace of this many seconds, instead of using --trace',
+        type=int,
+        default=None
+    )
+    argparser.add_argument(
+        '--seed',
+        dest='seed',
+        help='Random seed used by --synthetic',
+        type=int,
+        default=None
+    )
+    argparser.add_argument(
+        '--log_level',
+        dest='log_level',
+        help='Python logging level to stdout, use 10, 20, 30, 40, 50. Default is 30 (WARNING)',
+        type=int,
+        default=logging.WARNING
+    )
     return argparser.parse_args()
@@ -0,0 +1,49 @@
+import time
+from datetime import datetime, tzinfo
+from typing import Optional
+
+
+
+class Clock:
+    "The system clock. Modules take a clock so the simulator can swap in a virtual one."
+
+    def time(self) -> float:
+        return time.time()
+
+
+    def now(self, tz: Optional[tzinfo] = None) -> datetime:
+        return datetime.now(tz)
+
+
+    def sleep(self, seconds: float) -> None:
+        time.sleep(seconds)
+
+
+
+class VirtualClock(Clock):
+    "A clock that only moves when it is advanced, used for simulations."
+
+    def __init__(self, start: float) -> None:
+        self._time = start
+
+
+    def time(self) -> float:
+        return self._time
+
+
+    def now(self, tz: Optional[tzinfo] = None) -> datetime:
+        return datetime.fromtimestamp(self._time, tz)
+
+
+    def sleep(self, seconds: float) -> None:
+        raise RuntimeError("VirtualClock can't sleep, advance it instead")
+
+
+    def advance_to(self, timestamp: float) -> None:
+        if timestamp < self._time:
+            raise ValueError("VirtualClock can't go backwards")
+        self._time = timestamp
+
+
+
+system_clock = Clock()
@@ -1,4 +1,4 @@
-from dataclasses import dataclass, field
+from dataclasses import dataclass, replace
 from typing import List, Optional, Union, Literal
 from dataclass_wizard import YAMLWizard # type: ignore
 
@@ -12,6 +12,10 @@ class ClientConfig(YAMLWizard):
     https_verify: bool
     download_shares: int = 1
     upload_shares: int = 1
+    min_upload: Optional[float] = None
+    max_upload: Optional[float] = None
+    min_download: Optional[float] = None
+    max_download: Optional[float] = None
 
 
 @dataclass(frozen=True)
@@ -30,6 +34,8 @@ class MediaServerConfig(YAMLWizard):
     ignore_streams: IgnoreStreamConfig
     token: Optional[str] = None
     api_key: Optional[str] = None
+    bitrate_overrides: Optional[dict[str, float]] = None
+    bandwidth_mode: Literal['reserved', 'measured'] = 'reserved'
 
     def __hash__(self) -> int:
         return super().__hash__()
@@ -42,10 +48,81 @@ class ScheduleConfig(YAMLWizard):
     upload: Union[int, str]
     download: Union[int, str]
 
+@dataclass(frozen=True)
+class UsenetConfig(YAMLWizard):
+    type: Literal['sabnzbd', 'nzbget']
+    url: str
+    https_verify: bool
+    download: Union[int, str]
+    update_interval: int = 5
+    api_key: Optional[str] = None
+    username: Optional[str] = None
+    password: Optional[str] = None
+
+    def __hash__(self) -> int:
+        return super().__hash__()
+
+@dataclass(frozen=True)
+class DataCapConfig(YAMLWizard):
+    state_path: str
+    upload_cap: Optional[float] = None
+    download_cap: Optional[float] = None
+    cap_units: str = "GB"
+    billing_day: int = 1
+    burst: float = 10
+    margin: float = 1
+    update_interval: int = 60
+
+@dataclass(frozen=True)
+class StreamRuleConfig(YAMLWizard):
+    action: Literal['ignore', 'cap', 'multiply']
+    value: Optional[float] = None
+    server_type: Optional[Literal['plex', 'tautulli', 'jellyfin', 'emby']] = None
+    user: Optional[str] = None
+    player: Optional[str] = None
+    library: Optional[str] = None
+    transcode: Optional[bool] = None
+
 @dataclass(frozen=True)
 class ModulesConfig(YAMLWizard):
     media_servers: Optional[List[MediaServerConfig]]
     schedule: Optional[List[ScheduleConfig]]
+    usenet: Optional[List[UsenetConfig]] = None
+    data_cap: Optional[DataCapConfig] = None
+    stream_rules: Optional[List[StreamRuleConfig]] = None
+
+@dataclass(frozen=True)
+class PoolConfig(YAMLWizard):
+    name: str
+    min_upload: int
+    max_upload: int
+    min_download: int
+    max_download: int
+    clients: List[ClientConfig]
+    modules: ModulesConfig
+    manual_speed_algorithm_share: Optional[bool] = False
+
+@dataclass(frozen=True)
+class HistoryTierConfig(YAMLWizard):
+    resolution: int
+    duration: int
+
+@dataclass(frozen=True)
+class HistoryConfig(YAMLWizard):
+    host: str = "127.0.0.1"
+    port: int = 8321
+    tiers: Optional[tuple[HistoryTierConfig, ...]] = None
+
+@dataclass(frozen=True)
+class CoordinatorConfig(YAMLWizard):
+    role: Literal['authority', 'member']
+    address: str
+    name: Optional[str] = None
+    lease: int = 30
+    update_interval: int = 10
+    fallback_upload: Optional[int] = None
+    fallback_download: Optional[int] = None
+    secret: Optional[str] = None
 
 @dataclass(frozen=True)
 class SpeedrrConfig(YAMLWizard):
@@ -79,16 +156,79 @@ class SpeedrrConfig(YAMLWizard):
         'GiB',
         'gibibyte',
     ]
-    min_upload: int
-    max_upload: int
-    min_download: int
-    max_download: int
-    clients: List[ClientConfig]
-    modules: ModulesConfig
+    # Only optional so they can be left out when pools are used, `load_config` checks they are set otherwise
+    min_upload: int = None # type: ignore
+    max_upload: int = None # type: ignore
+    min_download: int = None # type: ignore
+    max_download: int = None # type: ignore
+    clients: List[ClientConfig] = None # type: ignore
+    modules: Optional[ModulesConfig] = None
     manual_speed_algorithm_share: Optional[bool] = False
+    history: Optional[HistoryConfig] = None
+    pools: Optional[List[PoolConfig]] = None
+    coordinator: Optional[CoordinatorConfig] = None
 
 def load_config(config_file: str) -> SpeedrrConfig:
     config = SpeedrrConfig.from_yaml_file(config_file)
     if isinstance(config, list):
         raise ValueError("Config can't be a list")
+
+    if config.pools:
+        if config.clients or config.modules:
+            raise ValueError("Clients and modules must be inside each pool when pools are used")
+
+        names = [pool.name for pool in config.pools]
+        if len(names) != len(set(names)):
+            raise ValueError("Pool names must be unique")
+
+        if config.coordinator:
+            raise ValueError("The coordinator can't be used with pools, it shares a single uplink between instances")
+
+    else:
+        for name in ("min_upload", "max_upload", "min_download", "max_download", "clients"):
+            if getattr(config, name) is None:
+                raise ValueError(f"{name} is missing from the config")
+
+    if config.history and config.history.tiers:
+        resolutions = [tier.resolution for tier in config.history.tiers]
+        if any(tier.resolution <= 0 or tier.duration < tier.resolution for tier in config.history.tiers):
+            raise ValueError("History tiers need a resolution above 0, and a duration of at least their resolution")
+
+        if resolutions != sorted(resolutions):
+            raise ValueError("History tiers must be ordered from the finest resolution to the coarsest")
+
+    for _, pool_config in pool_configs(config):
+        data_cap = pool_config.modules.data_cap if pool_config.modules else None
+        if data_cap and not 1 <= data_cap.billing_day <= 28:
+            raise ValueError("data_cap billing_day must be between 1 and 28")
+
+        stream_rules = pool_config.modules.stream_rules if pool_config.modules else None
+        for i, rule in enumerate(stream_rules or []):
+            if rule.action != "ignore" and rule.value is None:
+                raise ValueError(f"Stream rule {i + 1} needs a value for the {rule.action} action")
+
+    if not config.pools and config.modules is None:
+        config = replace(config, modules=ModulesConfig(media_servers=None, schedule=None))
+
     return config
+
+def pool_configs(config: SpeedrrConfig) -> List[tuple[Optional[str], SpeedrrConfig]]:
+    """Split the config into one config per uplink pool, as `(name, config)`.
+    If no pools are configured, the whole config is a single pool without a name."""
+    if not config.pools:
+        return [(None, config)]
+
+    return [
+        (pool.name, replace(
+            config,
+            min_upload = pool.min_upload,
+            max_upload = pool.max_upload,
+            min_download = pool.min_download,
+            max_download = pool.max_download,
+            clients = pool.clients,
+            modules = pool.modules,
+            manual_speed_algorithm_share = pool.manual_speed_algorithm_share,
+            pools = None,
+        ))
+        for pool in config.pools
+    ]
@@ -0,0 +1,342 @@
+import json
+import hmac
+import os
+import uuid
+import socket
+import socketserver
+import threading
+import traceback
+from typing import Optional, Union
+
+from helpers.config import SpeedrrConfig, CoordinatorConfig
+from helpers.log_loader import logger
+from helpers.bit_convert import bit_conv
+from helpers.history import history
+from helpers.clock import Clock, system_clock
+from helpers.allocator import allocate
+
+
+
+def parse_address(address: str) -> tuple[socket.AddressFamily, Union[str, tuple[str, int]]]:
+    "Parse a coordinator address, either `host:port` or `unix:/path/to/socket`. Returns `(family, address)`."
+    if address.startswith("unix:"):
+        return socket.AF_UNIX, address[len("unix:"):]
+
+    host, _, port = address.rpartition(":")
+    return socket.AF_INET, (host or "127.0.0.1", int(port))
+
+
+
+class BaseCoordinator:
+    """Shares one uplink between several speedrr instances.
+
+    Every instance tells the authority how much it wants (its demand), and is leased a slice of the
+    authority's max speeds, which caps its own speeds. Speeds are sent as B/s, so instances can use different units."""
+
+    def __init__(self, config: SpeedrrConfig, coordinator_config: CoordinatorConfig, update_event: threading.Event, clock: Clock = system_clock) -> None:
+        self._config = config
+        self._coordinator_config = coordinator_config
+        self._update_event = update_event
+        self._clock = clock
+
+        self.name = coordinator_config.name or socket.gethostname()
+        self._logger_prefix = f"<coordinator|{self.name}>"
+
+        # Unique to this run, so the authority can tell instances using the same name apart
+        self._instance = uuid.uuid4().hex
+
+        # This instance's demand, in config units, until the first update says otherwise
+        self._demand = (float(config.max_upload), float(config.max_download))
+        self._demand_changed = threading.Event()
+
+        # The slice this instance was last given, in config units
+        self._slice: Optional[tuple[float, float]] = None
+
+
+    def set_demand(self, upload: float, download: float) -> None:
+        "Set how much this instance wants, in config units. The lease is renewed straight away if it changed."
+        if (upload, download) != self._demand:
+            self._demand = (upload, download)
+            self._demand_changed.set()
+
+
+    def get_slice(self) -> tuple[float, float]:
+        "The `(upload, download)` this instance is allowed to use, in config units."
+        raise NotImplementedError("get_slice must be implemented in a subclass")
+
+
+    def renew(self) -> None:
+        "Send this instance's demand, and update its slice."
+        raise NotImplementedError("renew must be implemented in a subclass")
+
+
+    def set_slice(self, new_slice: Optional[tuple[float, float]]) -> None:
+        "Set the slice of this instance, and dispatch an update event if it changed."
+        if new_slice != self._slice:
+            logger.info(f"{self._logger_prefix} New slice: {new_slice}")
+            self._slice = new_slice
+            self._update_event.set()
+
+
+    def to_bytes(self, speeds: tuple[float, float]) -> tuple[float, float]:
+        return bit_conv(speeds[0], self._config.units, 'B'), bit_conv(speeds[1], self._config.units, 'B')
+
+
+    def from_bytes(self, speeds: tuple[float, float]) -> tuple[float, float]:
+        return bit_conv(speeds[0], 'B', self._config.units), bit_conv(speeds[1], 'B', self._config.units)
+
+
+    def run(self) -> None:
+        thread = threading.Thread(target=self.loop)
+        thread.daemon = True
+        thread.start()
+
+
+    def loop(self) -> None:
+        while True:
+            try:
+                self.renew()
+            except Exception:
+                logger.warning(f"{self._logger_prefix} Error renewing lease:\n" + traceback.format_exc())
+
+            self._demand_changed.wait(timeout=self._coordinator_config.update_interval)
+            self._demand_changed.clear()
+
+
+
+class AuthorityCoordinator(BaseCoordinator):
+    "The instance that owns the uplink, whose max speeds are split between every instance with a lease, including itself."
+
+    def __init__(self, config: SpeedrrConfig, coordinator_config: CoordinatorConfig, update_event: threading.Event, clock: Clock = system_clock) -> None:
+        super().__init__(config, coordinator_config, update_event, clock)
+
+        self._budget = self.to_bytes((config.max_upload, config.max_download))
+
+        # The demand of each instance in B/s, when its lease expires, and the instance holding it
+        self._leases: dict[str, tuple[float, float, float, str]] = {}
+        # The slice each instance with a lease was last given in B/s, which it keeps using until it renews
+        self._granted: dict[str, tuple[float, float]] = {}
+        self._lock = threading.Lock()
+
+        self._server: Optional[socketserver.BaseServer] = None
+
+
+    def register(self, name: str, instance: str, upload: float, download: float) -> tuple[float, float]:
+        """Renew the lease of an instance with its demand, and return its slice. Both in B/s.
+        Raises a `ValueError` if the name is the authority's, or has a live lease held by another instance.
+
+        The slice is its fair share, but never more than the others haven't been given yet. The others only
+        learn their new (smaller) share when they renew, so until then a new or growing instance gets less."""
+
+        now = self._clock.time()
+
+        with self._lock:
+            for other, lease in list(self._leases.items()):
+                if lease[2] < now:
+                    logger.warning(f"{self._logger_prefix} Lease of {other} expired, removing it")
+                    del self._leases[other]
+                    self._granted.pop(other, None)
+
+            if name == self.name and instance != self._instance:
+                raise ValueError(f"{name} is the authority's name, set a unique name on the member")
+
+            if name in self._leases and self._leases[name][3] != instance:
+                raise ValueError(f"{name} already has a lease held by another instance, set a unique name on each instance")
+
+            if name not in self._leases:
+                logger.info(f"{self._logger_prefix} {name} registered")
+
+            self._leases[name] = (max(0, upload), max(0, download), now + self._coordinator_config.lease, instance)
+
+            names = list(self._leases)
+            weights = [1] * len(names)
+            uploads = allocate(self._budget[0], weights, None, [self._leases[other][0] for other in names])
+            downloads = allocate(self._budget[1], weights, None, [self._leases[other][1] for other in names])
+            fair = dict(zip(names, zip(uploads, downloads)))
+
+            # The authority's own slice is local, so it can shrink straight away to make room
+            if self.name in self._granted:
+                self._granted[self.name] = (
+                    min(self._granted[self.name][0], fair[self.name][0]),
+                    min(self._granted[self.name][1], fair[self.name][1]),
+                )
+
+            self._granted[name] = self.available(name, fair[name])
+
+            # And grow into what is left
+            if name != self.name and self.name in self._leases:
+                self._granted[self.name] = self.available(self.name, fair[self.name])
+
+            slices = dict(self._granted)
+
+        for other, (other_upload, other_download) in slices.items():
+            history.record(f"coordinator.{other}.upload", bit_conv(other_upload, 'B', self._config.units), now)
+            history.record(f"coordinator.{other}.download", bit_conv(other_download, 'B', self._config.units), now)
+
+        # Another instance registering can change this instance's slice too
+        if self.name in slices:
+            self.set_slice(self.from_bytes(slices[self.name]))
+
+        return slices[name]
+
+
+    def available(self, name: str, fair: tuple[float, float]) -> tuple[float, float]:
+        "An instance's fair share in B/s, limited to the budget the other instances' slices leave. Must hold the lock."
+        return (
+            min(fair[0], max(0, self._budget[0] - sum(granted[0] for other, granted in self._granted.items() if other != name))),
+            min(fair[1], max(0, self._budget[1] - sum(granted[1] for other, granted in self._granted.items() if other != name))),
+        )
+
+
+    def renew(self) -> None:
+        self.register(self.name, self._instance, *self.to_bytes(self._demand))
+
+
+    def set_demand(self, upload: float, download: float) -> None:
+        # The slice is local, so it is updated before the speeds are calculated
+        if (upload, download) != self._demand:
+            self._demand = (upload, download)
+            self.renew()
+
+
+    def get_slice(self) -> tuple[float, float]:
+        if self._slice is None:
+            self.renew()
+
+        assert self._slice is not None
+        return self._slice
+
+
+    def serve(self) -> None:
+        "Start answering members in a thread, without renewing this instance's own lease."
+
+        family, address = parse_address(self._coordinator_config.address)
+
+        if family == socket.AF_UNIX:
+            assert isinstance(address, str)
+            # Left behind if the last run didn't exit cleanly
+            if os.path.exists(address):
+                os.unlink(address)
+            self._server = UnixCoordinatorServer(address, CoordinatorRequestHandler)
+        else:
+            self._server = TCPCoordinatorServer(address, CoordinatorRequestHandler)
+
+        self._server.authority = self # type: ignore
+
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        logger.info(f"{self._logger_prefix} Coordinating on {self._coordinator_config.address}")
+
+
+    def run(self) -> None:
+        self.serve()
+        super().run()
+
+
+
+class MemberCoordinator(BaseCoordinator):
+    "An instance that leases its slice from the authority, and falls back to its fallback speeds if the lease runs out."
+
+    def __init__(self, config: SpeedrrConfig, coordinator_config: CoordinatorConfig, update_event: threading.Event, clock: Clock = system_clock) -> None:
+        super().__init__(config, coordinator_config, update_event, clock)
+
+        self._fallback = (
+            coordinator_config.fallback_upload if coordinator_config.fallback_upload is not None else config.min_upload,
+            coordinator_config.fallback_download if coordinator_config.fallback_download is not None else config.min_download,
+        )
+        self._lease_expires: Optional[float] = None
+
+
+    def request(self, message: dict) -> dict:
+        "Send one request to the authority, and return its response."
+
+        family, address = parse_address(self._coordinator_config.address)
+
+        if family == socket.AF_UNIX:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(5)
+            sock.connect(address)
+        else:
+            assert isinstance(address, tuple)
+            sock = socket.create_connection(address, timeout=5)
+
+        with sock, sock.makefile("rwb") as stream:
+            stream.write(json.dumps(message).encode() + b"\n")
+            stream.flush()
+            response: dict = json.loads(stream.readline())
+
+        if "error" in response:
+            raise Exception(f"Error from authority: {response['error']}")
+
+        return response
+
+
+    def renew(self) -> None:
+        try:
+            upload, download = self.to_bytes(self._demand)
+            logger.debug(f"{self._logger_prefix} Renewing lease, demand {upload}B upload and {download}B download")
+
+            response = self.request({
+                "name": self.name,
+                "instance": self._instance,
+                "secret": self._coordinator_config.secret,
+                "upload": upload,
+                "download": download,
+            })
+
+        except Exception:
+            if self._lease_expires is not None and self._clock.time() >= self._lease_expires:
+                logger.warning(f"{self._logger_prefix} Lease expired, using fallback speeds")
+                self._lease_expires = None
+                self.set_slice(None)
+            raise
+
+        self._lease_expires = self._clock.time() + response["lease"]
+        self.set_slice(self.from_bytes((response["upload"], response["download"])))
+
+
+    def get_slice(self) -> tuple[float, float]:
+        if self._slice is None or self._lease_expires is None or self._clock.time() >= self._lease_expires:
+            return self._fallback
+
+        return self._slice
+
+
+
+class CoordinatorRequestHandler(socketserver.StreamRequestHandler):
+    """Handles one request per connection, a JSON object per line:
+    `{name, instance, secret, upload, download}` in, `{upload, download, lease}` or `{error}` out."""
+
+    def handle(self) -> None:
+        authority: AuthorityCoordinator = self.server.authority # type: ignore
+
+        try:
+            request = json.loads(self.rfile.readline())
+
+            secret = authority._coordinator_config.secret
+            if secret is not None and not hmac.compare_digest(str(request.get("secret")).encode(), secret.encode()):
+                raise ValueError("Wrong secret")
+
+            upload, download = authority.register(str(request["name"]), str(request["instance"]), float(request["upload"]), float(request["download"]))
+            response = {"upload": upload, "download": download, "lease": authority._coordinator_config.lease}
+
+        except Exception as e:
+            logger.warning(f"{authority._logger_prefix} Rejected request from {self.client_address or 'unix socket'}: {e}")
+            response = {"error": str(e)}
+
+        self.wfile.write(json.dumps(response).encode() + b"\n")
+
+
+
+class TCPCoordinatorServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+
+# Unix sockets aren't available on Windows
+if hasattr(socketserver, "ThreadingUnixStreamServer"):
+    class UnixCoordinatorServer(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
@@ -0,0 +1,313 @@
+import threading
+import json
+import math
+from array import array
+from typing import Optional, List, Tuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import urllib.parse
+import time
+from datetime import datetime
+import httpx
+
+from helpers.config import HistoryConfig, HistoryTierConfig
+from helpers.log_loader import logger
+
+
+
+default_tiers = (
+    HistoryTierConfig(resolution=1, duration=60 * 60),
+    HistoryTierConfig(resolution=60, duration=7 * 24 * 60 * 60),
+)
+
+
+class RingBuffer:
+    """A fixed size buffer of `(timestamp, value)` pairs, backed by preallocated arrays.
+    Each pair also keeps the last raw sample that went into it, for `last_at`."""
+
+    __slots__ = ("resolution", "capacity", "_times", "_values", "_last_times", "_last_values", "_index", "_size")
+
+    def __init__(self, resolution: int, capacity: int) -> None:
+        self.resolution = resolution
+        self.capacity = capacity
+
+        self._times = array('d', bytes(8 * capacity))
+        self._values = array('d', bytes(8 * capacity))
+        self._last_times = array('d', bytes(8 * capacity))
+        self._last_values = array('d', bytes(8 * capacity))
+        self._index = 0
+        self._size = 0
+
+
+    def push(self, timestamp: float, value: float, last_time: float, last_value: float) -> None:
+        self._times[self._index] = timestamp
+        self._values[self._index] = value
+        self._last_times[self._index] = last_time
+        self._last_values[self._index] = last_value
+
+        self._index = (self._index + 1) % self.capacity
+        if self._size < self.capacity:
+            self._size += 1
+
+
+    def oldest(self) -> Optional[float]:
+        "The timestamp of the oldest point in the buffer, or `None` if empty."
+        if self._size == 0:
+            return None
+        return self._times[(self._index - self._size) % self.capacity]
+
+
+    def points(self, start: float, end: float) -> List[Tuple[float, float]]:
+        "All points between `start` and `end` (inclusive), oldest first."
+        result = []
+        for offset in range(self._size, 0, -1):
+            i = (self._index - offset) % self.capacity
+            if start <= self._times[i] <= end:
+                result.append((self._times[i], self._values[i]))
+        return result
+
+
+    def last_at(self, timestamp: float) -> Optional[Tuple[float, float]]:
+        "The newest raw sample at or before `timestamp`, or `None` if there isn't one."
+        for offset in range(1, self._size + 1):
+            i = (self._index - offset) % self.capacity
+            if self._last_times[i] <= timestamp:
+                return self._last_times[i], self._last_values[i]
+        return None
+
+
+
+class TimeSeries:
+    """A series of samples, stored at multiple resolutions.
+
+    Each tier averages the samples that land in one of its buckets, and stores the average
+    once the bucket is closed, so older data is kept at a coarser resolution."""
+
+    __slots__ = ("tiers", "raw", "_bucket_start", "_bucket_sum", "_bucket_count", "_bucket_last_time", "_bucket_last_value")
+
+    def __init__(self, tiers: Tuple[HistoryTierConfig, ...]) -> None:
+        self.tiers = tuple(
+            RingBuffer(tier.resolution, max(1, tier.duration // tier.resolution))
+            for tier in tiers
+        )
+
+        # The latest raw samples, as many as the finest tier holds, so `value_at` is exact for recent times
+        self.raw = RingBuffer(0, self.tiers[0].capacity)
+
+        # Open bucket of each tier, kept in arrays so recording doesn't allocate.
+        self._bucket_start = array('d', [math.nan] * len(self.tiers))
+        self._bucket_sum = array('d', bytes(8 * len(self.tiers)))
+        self._bucket_count = array('L', bytes(array('L').itemsize * len(self.tiers)))
+        self._bucket_last_time = array('d', bytes(8 * len(self.tiers)))
+        self._bucket_last_value = array('d', bytes(8 * len(self.tiers)))
+
+
+    def record(self, timestamp: float, value: float) -> None:
+        self.raw.push(timestamp, value, timestamp, value)
+
+        for i, tier in enumerate(self.tiers):
+            bucket_start = timestamp - timestamp % tier.resolution
+
+            if bucket_start != self._bucket_start[i]:
+                if self._bucket_count[i]:
+                    tier.push(
+                        self._bucket_start[i], self._bucket_sum[i] / self._bucket_count[i],
+                        self._bucket_last_time[i], self._bucket_last_value[i]
+                    )
+
+                self._bucket_start[i] = bucket_start
+                self._bucket_sum[i] = 0
+                self._bucket_count[i] = 0
+
+            self._bucket_sum[i] += value
+            self._bucket_count[i] += 1
+            self._bucket_last_time[i] = timestamp
+            self._bucket_last_value[i] = value
+
+
+    def query(self, start: float, end: float) -> List[Tuple[float, float]]:
+        "Points between `start` and `end`, using the finest resolution available for each period."
+        result: List[Tuple[float, float]] = []
+        covered_from = math.inf
+
+        for i, tier in enumerate(self.tiers):
+            pending = []
+            if self._bucket_count[i] and start <= self._bucket_start[i] <= end:
+                pending.append((self._bucket_start[i], self._bucket_sum[i] / self._bucket_count[i]))
+
+            tier_points = [
+                point for point in tier.points(start, end) + pending
+                if point[0] < covered_from
+            ]
+            result = tier_points + result
+
+            oldest = tier.oldest()
+            if oldest is None and pending:
+                oldest = pending[0][0]
+            if oldest is not None:
+                covered_from = min(covered_from, oldest)
+
+        return result
+
+
+    def value_at(self, timestamp: float) -> Optional[float]:
+        """The last raw sample recorded at or before `timestamp`, from the finest tier that has one.
+        Bucket averages aren't used, as they can include samples recorded after `timestamp`.
+        Before the oldest raw sample, it's the last sample of the latest bucket whose samples were all recorded by then."""
+        point = self.raw.last_at(timestamp)
+        if point is not None:
+            return point[1]
+
+        for i, tier in enumerate(self.tiers):
+            # The open bucket is newer than anything in the tier
+            if self._bucket_count[i] and self._bucket_last_time[i] <= timestamp:
+                return self._bucket_last_value[i]
+
+            point = tier.last_at(timestamp)
+            if point is not None:
+                return point[1]
+
+        return None
+
+
+
+class History:
+    "Bounded in-memory history of every recorded series, such as bandwidth, reductions and applied limits."
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.series: dict[str, TimeSeries] = {}
+
+        self._tiers: Tuple[HistoryTierConfig, ...] = default_tiers
+        self._lock = threading.Lock()
+
+
+    def configure(self, config: HistoryConfig) -> None:
+        self._tiers = tuple(config.tiers) if config.tiers else default_tiers
+        self.enabled = True
+
+
+    def record(self, name: str, value: float, timestamp: Optional[float] = None) -> None:
+        "Record a sample for a series, does nothing if history isn't enabled."
+        if not self.enabled:
+            return
+
+        if timestamp is None:
+            timestamp = time.time()
+
+        with self._lock:
+            series = self.series.get(name)
+            if series is None:
+                series = self.series[name] = TimeSeries(self._tiers)
+
+            series.record(timestamp, value)
+
+
+    def query(self, name: str, start: float, end: float) -> List[Tuple[float, float]]:
+        with self._lock:
+            series = self.series.get(name)
+            if series is None:
+                raise KeyError(name)
+
+            return series.query(start, end)
+
+
+    def value_at(self, name: str, timestamp: float) -> Optional[float]:
+        "The last value recorded for a series at or before `timestamp`."
+        with self._lock:
+            series = self.series.get(name)
+            if series is None:
+                raise KeyError(name)
+
+            return series.value_at(timestamp)
+
+
+
+history = History()
+
+
+
+class HistoryRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        url = urllib.parse.urlparse(self.path)
+        params = urllib.parse.parse_qs(url.query)
+
+        if url.path != "/history":
+            self.send_json(404, {"error": "Not found"})
+            return
+
+        if "series" not in params:
+            with history._lock:
+                names = sorted(history.series)
+            self.send_json(200, {"series": names})
+            return
+
+        name = params["series"][0]
+        try:
+            if "at" in params:
+                self.send_json(200, {"series": name, "value": history.value_at(name, float(params["at"][0]))})
+            else:
+                points = history.query(
+                    name,
+                    float(params.get("start", [0])[0]),
+                    float(params.get("end", [math.inf])[0]),
+                )
+                self.send_json(200, {"series": name, "points": points})
+
+        except KeyError:
+            self.send_json(404, {"error": f"Unknown series: {name}"})
+
+        except ValueError:
+            self.send_json(400, {"error": "start, end and at must be unix timestamps"})
+
+
+    def send_json(self, status: int, body: dict) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+    def log_message(self, format, *args) -> None:
+        logger.debug("<history> " + format % args)
+
+
+
+def start_server(config: HistoryConfig) -> ThreadingHTTPServer:
+    "Serve the history over HTTP on a daemon thread."
+    server = ThreadingHTTPServer((config.host, config.port), HistoryRequestHandler)
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    logger.info(f"<history> Serving history on http://{config.host}:{config.port}/history")
+    return server
+
+
+
+def parse_timestamp(value: str) -> float:
+    "Parse a unix timestamp, an ISO datetime, or a `HH:MM` time today (local time)."
+    try:
+        return float(value)
+    except ValueError:
+        pass
+
+    if len(value) <= 5 and ':' in value:
+        hour, minute = map(int, value.split(':'))
+        return datetime.now().replace(hour=hour, minute=minute, second=0, microsecond=0).timestamp()
+
+    return datetime.fromisoformat(value).timestamp()
+
+
+def query_server(config: HistoryConfig, series: str, at: Optional[str]) -> dict:
+    "Query the history endpoint of a running instance. Use `list` as the series to list all series."
+    params = {}
+    if series != "list":
+        params["series"] = series
+    if at is not None:
+        params["at"] = str(parse_timestamp(at))
+
+    res = httpx.get(f"http://{config.host}:{config.port}/history", params=params)
+    return res.json()
@@ -29,13 +29,22 @@ class ColourFormatter(logging.Formatter):
 
 
 logger = logging.getLogger(logger_name)
-logger.setLevel(logging.DEBUG)
 
 stdout_handler = logging.StreamHandler()
 stdout_handler.setLevel(default_stdout_log_level)
 stdout_handler.setFormatter(ColourFormatter())
 logger.addHandler(stdout_handler)
 
+def update_level() -> None:
+    "Set the logger's level to the lowest of its handlers', so records no handler shows aren't created at all."
+    logger.setLevel(min(handler.level for handler in logger.handlers))
+
+def set_stdout_level(level: int) -> None:
+    stdout_handler.setLevel(level)
+    update_level()
+
+update_level()
+
 def set_file_handler(folder: str, level: int) -> None:
     path = pathlib.Path(folder)
     path.mkdir(parents=True, exist_ok=True)
@@ -44,6 +53,7 @@ def set_file_handler(folder: str, level: int) -> None:
     file_handler.setLevel(level)
     file_handler.setFormatter(logging.Formatter(log_format))
     logger.addHandler(file_handler)
+    update_level()
 
 def handle_exception(exc_type, exc_value, exc_traceback):
     if issubclass(exc_type, KeyboardInterrupt):
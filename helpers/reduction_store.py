@@ -0,0 +1,61 @@
+import threading
+from types import MappingProxyType
+from typing import Any, Hashable, Mapping, NamedTuple
+
+
+
+class ReductionSnapshot(NamedTuple):
+    "An immutable view of every source's `(upload, download)` reduction, in config units."
+    version: int
+    values: Mapping[Any, tuple[float, float]]
+    upload: float
+    download: float
+
+
+
+class ReductionStore:
+    """The reductions of a module, per source (e.g. per server or schedule).
+
+    Writers publish a new immutable snapshot with a higher version, so readers never need a lock,
+    and can tell whether anything changed since they last looked by comparing versions."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._snapshot = ReductionSnapshot(0, MappingProxyType({}), 0, 0)
+
+
+    @property
+    def snapshot(self) -> ReductionSnapshot:
+        return self._snapshot
+
+
+    def publish(self, values: Mapping[Hashable, tuple[float, float]]) -> bool:
+        "Set the reduction of one or more sources. Returns whether anything changed, the version is only bumped if it did."
+        return self._update(values, ())
+
+
+    def remove(self, source: Hashable) -> bool:
+        "Remove the reduction of a source. Returns whether it existed."
+        return self._update({}, (source,))
+
+
+    def _update(self, values: Mapping[Hashable, tuple[float, float]], removed: tuple) -> bool:
+        with self._lock:
+            old = self._snapshot
+
+            if all(old.values.get(source) == value for source, value in values.items()) \
+                    and not any(source in old.values for source in removed):
+                return False
+
+            new_values = dict(old.values)
+            new_values.update(values)
+            for source in removed:
+                new_values.pop(source, None)
+
+            self._snapshot = ReductionSnapshot(
+                old.version + 1,
+                MappingProxyType(new_values),
+                sum(value[0] for value in new_values.values()),
+                sum(value[1] for value in new_values.values()),
+            )
+            return True
@@ -0,0 +1,86 @@
+from typing import Any, List, NamedTuple, Optional, Sequence
+
+from helpers.config import StreamRuleConfig
+from helpers.bit_convert import bit_conv
+
+
+
+# The fields a rule can match on, in the order `StreamPolicy.decide` takes them
+DIMENSIONS = ("server_type", "user", "player", "library", "transcode")
+
+
+
+class StreamDecision(NamedTuple):
+    "What to do with a stream. `value` is in Kbit/s for `cap`, and a multiplier for `multiply`."
+    rule: int
+    action: str
+    value: float
+
+
+
+class StreamPolicy:
+    """Stream rules, compiled into a decision table when loaded.
+
+    For every field a rule matches on, the table maps each value to a bitmask of the rules it matches,
+    plus a bitmask of the rules that don't care about that field. A stream's matching rules are the AND
+    of its masks, and the first rule that matches is the lowest bit set. So deciding takes a dict lookup
+    per field that any rule matches on, no matter how many rules there are."""
+
+    def __init__(self, rules: Sequence[StreamRuleConfig], units: str) -> None:
+        self._decisions: List[StreamDecision] = [
+            StreamDecision(
+                i,
+                rule.action,
+                bit_conv(rule.value, units, 'Kbit') if rule.action == "cap" else (rule.value or 0)
+            )
+            for i, rule in enumerate(rules)
+        ]
+
+        self._all_rules = (1 << len(rules)) - 1
+
+        # (position in the key, value -> rules matching it, rules matching any value)
+        self._table: List[tuple[int, dict[Any, int], int]] = []
+
+        for position, dimension in enumerate(DIMENSIONS):
+            values: dict[Any, int] = {}
+            wildcard = 0
+
+            for i, rule in enumerate(rules):
+                condition = getattr(rule, dimension)
+                if condition is None:
+                    wildcard |= 1 << i
+                else:
+                    condition = normalize(condition)
+                    values[condition] = values.get(condition, 0) | 1 << i
+
+            # Fields no rule matches on can't rule anything out
+            if values:
+                self._table.append((position, values, wildcard))
+
+
+    def decide(self, server_type: str, user: str, player: str, library: str, transcode: bool) -> Optional[StreamDecision]:
+        "The decision of the first rule matching a stream, or `None` if no rule matches."
+
+        if not self._table:
+            # No rule matches on anything, so the first one (if any) matches every stream
+            return self._decisions[0] if self._decisions else None
+
+        key = (server_type, user, player, library, transcode)
+        matches = self._all_rules
+
+        for position, values, wildcard in self._table:
+            # Only the fields some rule matches on are normalized, the same way as the conditions
+            value = key[position]
+            if value.__class__ is str:
+                value = value.strip().lower()
+
+            matches &= values.get(value, 0) | wildcard
+            if not matches:
+                return None
+
+        return self._decisions[(matches & -matches).bit_length() - 1]
+
+
+
+def normalize(condition: Any) -> Any:
+    return condition.strip().lower() if isinstance(condition, str) else condition
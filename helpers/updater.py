@@ -0,0 +1,221 @@
+from typing import Union, List, Literal, Optional, Protocol, runtime_checkable
+import threading
+import traceback
+import math
+
+from helpers.config import SpeedrrConfig, ClientConfig
+from helpers.log_loader import logger
+from helpers.history import history
+from helpers.clock import Clock, system_clock
+from helpers.allocator import allocate
+from helpers.bit_convert import bit_convertion_dict
+from helpers.reduction_store import ReductionStore
+
+
+
+class Module(Protocol):
+    reduction_store: ReductionStore
+
+    def get_reduction_value(self) -> tuple[float, float]: ...
+
+
+@runtime_checkable
+class CapModule(Protocol):
+    "A module that limits the speeds to a ceiling, rather than reducing them."
+    reduction_store: ReductionStore
+
+    def get_speed_cap(self) -> tuple[float, float]: ...
+
+
+class TorrentClient(Protocol):
+    _client_config: ClientConfig
+
+    def get_active_torrent_count(self) -> int: ...
+    def set_upload_speed(self, speed: Union[int, float]) -> None: ...
+    def set_download_speed(self, speed: Union[int, float]) -> None: ...
+
+
+class Coordinator(Protocol):
+    def set_demand(self, upload: float, download: float) -> None: ...
+    def get_slice(self) -> tuple[float, float]: ...
+
+
+
+class SpeedUpdater:
+    "Calculates the new speeds from the modules' reductions, and splits them between the clients."
+
+    def __init__(self, config: SpeedrrConfig, modules: List[Union[Module, CapModule]], clients: List[TorrentClient], clock: Clock = system_clock, name: Optional[str] = None, coordinator: Optional[Coordinator] = None) -> None:
+        self._config = config
+        self._modules = modules
+        self._clients = clients
+        self._clock = clock
+        self.name = name
+        self._coordinator = coordinator
+
+        self._logger_prefix = f"<pool|{name}> " if name else ""
+        self._history_prefix = f"pool.{name}." if name else ""
+
+        # The last reduction (or cap) of each module and the store version it was read at, so
+        # modules are only asked again once something was published to their store
+        self._module_reductions: dict[Union[Module, CapModule], tuple[int, tuple[float, float]]] = {}
+
+        # The `(upload, download)` limits each client was last successfully set with
+        self._last_limits: dict[TorrentClient, tuple[float, float]] = {}
+
+
+    def split_speed(self, speed: float, weights: List[int], direction: Literal["upload", "download"], idle_full_speed: bool) -> List[float]:
+        """Split a speed between the clients by weight, honoring each client's own min and max speed.
+
+        If `idle_full_speed` is set, clients without any weight (i.e. no active torrents) get the whole speed,
+        so they aren't stuck on a tiny limit if they become active before the next update."""
+
+        floors = [getattr(client._client_config, f"min_{direction}") for client in self._clients]
+        ceilings = [getattr(client._client_config, f"max_{direction}") for client in self._clients]
+
+        speeds = allocate(speed, weights, floors, ceilings)
+
+        if not idle_full_speed:
+            return speeds
+
+        for i, weight in enumerate(weights):
+            if weight <= 0:
+                speeds[i] = min(max(speed, floors[i] or 0), ceilings[i] if ceilings[i] is not None else speed)
+
+        return speeds
+
+
+    def quantize(self, speed: float) -> float:
+        """Round a speed in config units to a whole B/s, which is what the clients store.
+        The split can be an ulp off from one update to the next, which would otherwise rewrite a client with the same limit."""
+
+        unit = bit_convertion_dict[self._config.units] / bit_convertion_dict["B"]
+        return round(speed * unit) / unit
+
+
+    def update(self) -> dict[TorrentClient, tuple[float, float]]:
+        """Recalculate the speeds, and split them between the clients.
+        Only clients whose own limits changed are written to. Returns the `(upload, download)` limits that were set, per client."""
+
+        cfg = self._config
+        now = self._clock.time()
+
+        for module in self._modules:
+            # Read the version first, if the module publishes again in between it is just read again next time
+            version = module.reduction_store.snapshot.version
+            cached = self._module_reductions.get(module)
+            if cached is not None and cached[0] == version:
+                continue
+
+            if isinstance(module, CapModule):
+                upload_value, download_value = module.get_speed_cap()
+            else:
+                upload_value, download_value = module.get_reduction_value()
+
+            self._module_reductions[module] = (version, (upload_value, download_value))
+
+            # Caps are infinite for a direction without one
+            if math.isfinite(upload_value):
+                history.record(f"{self._history_prefix}module.{module.__class__.__name__}.upload", upload_value, now)
+            if math.isfinite(download_value):
+                history.record(f"{self._history_prefix}module.{module.__class__.__name__}.download", download_value, now)
+
+        module_reduction_values = [self._module_reductions[module][1] for module in self._modules if not isinstance(module, CapModule)]
+        module_cap_values = [self._module_reductions[module][1] for module in self._modules if isinstance(module, CapModule)]
+
+        # Caps win over the min speeds, or a data cap would be overrun by the min speeds alone
+        upload_cap = min([math.inf, *(module[0] for module in module_cap_values)])
+        download_cap = min([math.inf, *(module[1] for module in module_cap_values)])
+
+        # These are in the config's units
+        new_upload_speed = min(max(cfg.min_upload, cfg.max_upload - sum(module[0] for module in module_reduction_values)), upload_cap)
+        new_download_speed = min(max(cfg.min_download, cfg.max_download - sum(module[1] for module in module_reduction_values)), download_cap)
+
+        if self._coordinator:
+            # What this instance would use on its own, the rest of the uplink is left to the other instances
+            self._coordinator.set_demand(new_upload_speed, new_download_speed)
+            upload_slice, download_slice = self._coordinator.get_slice()
+
+            logger.info(f"{self._logger_prefix}Coordinator slice: {upload_slice}{cfg.units} upload, {download_slice}{cfg.units} download")
+
+            new_upload_speed = min(max(cfg.min_upload, min(new_upload_speed, upload_slice)), upload_cap)
+            new_download_speed = min(max(cfg.min_download, min(new_download_speed, download_slice)), download_cap)
+
+        logger.info(f"{self._logger_prefix}New calculated upload speed: {new_upload_speed}{cfg.units}")
+        logger.info(f"{self._logger_prefix}New calculated download speed: {new_download_speed}{cfg.units}")
+
+        history.record(f"{self._history_prefix}target.upload", new_upload_speed, now)
+        history.record(f"{self._history_prefix}target.download", new_download_speed, now)
+
+        logger.info(f"{self._logger_prefix}Getting active torrent counts")
+
+        client_active_torrent_dict = {
+            client: client.get_active_torrent_count()
+            for client in self._clients
+        }
+
+        if cfg.manual_speed_algorithm_share:
+            upload_weights = [client._client_config.upload_shares for client in self._clients]
+            download_weights = [client._client_config.download_shares for client in self._clients]
+        else:
+            upload_weights = download_weights = list(client_active_torrent_dict.values())
+
+        upload_speeds = self.split_speed(new_upload_speed, upload_weights, "upload", not cfg.manual_speed_algorithm_share)
+        download_speeds = self.split_speed(new_download_speed, download_weights, "download", not cfg.manual_speed_algorithm_share)
+
+        applied: dict[TorrentClient, tuple[float, float]] = {}
+
+        for torrent_client, upload_speed, download_speed in zip(self._clients, upload_speeds, download_speeds):
+            effective_upload_speed = self.quantize(upload_speed)
+            effective_download_speed = self.quantize(download_speed)
+
+            if self._last_limits.get(torrent_client) == (effective_upload_speed, effective_download_speed):
+                logger.info(f"Limits for {torrent_client._client_config.url} unchanged, not updating it")
+                continue
+
+            try:
+                torrent_client.set_upload_speed(effective_upload_speed)
+                torrent_client.set_download_speed(effective_download_speed)
+
+            except Exception:
+                logger.warning(f"An error occurred while updating {torrent_client._client_config.url}, skipping:\n" + traceback.format_exc())
+                # Retried on the next update, even if its limits don't change
+                self._last_limits.pop(torrent_client, None)
+
+            else:
+                applied[torrent_client] = self._last_limits[torrent_client] = (effective_upload_speed, effective_download_speed)
+                history.record(f"client.{torrent_client._client_config.url}.upload", effective_upload_speed, now)
+                history.record(f"client.{torrent_client._client_config.url}.download", effective_download_speed, now)
+                logger.info(f"Set upload speed for {torrent_client._client_config.url} to {effective_upload_speed}{cfg.units}")
+                logger.info(f"Set download speed for {torrent_client._client_config.url} to {effective_download_speed}{cfg.units}")
+
+
+        logger.info(f"{self._logger_prefix}Speeds updated")
+        return applied
+
+
+    def run(self, update_event: threading.Event) -> None:
+        "Update the speeds every time the update event is set."
+
+        # Force an initial update
+        update_event.set()
+
+        while True:
+            # Without a timeout, Ctrl+C won't work.
+            # Polling isn't great, but it will work.
+            event_triggered = update_event.wait(timeout=0.2)
+            if not event_triggered:
+                continue
+
+            # Clear immediately, so that the next event can be set.
+            update_event.clear()
+
+            logger.info(f"{self._logger_prefix}Update event triggered")
+
+            try:
+                self.update()
+
+            except Exception:
+                logger.error(f"{self._logger_prefix}An error occurred while updating clients:\n" + traceback.format_exc())
+
+
+            logger.info(f"{self._logger_prefix}Waiting for next update event")
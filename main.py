@@ -1,36 +1,19 @@
 import threading
-from typing import Union, List
-import traceback
+from datetime import datetime
+from typing import Union, List, Optional
+import httpx
 
 from helpers.log_loader import logger
 from helpers import arguments, config, log_loader
+from helpers.history import history, query_server, start_server
+from helpers.updater import SpeedUpdater
+from helpers.coordinator import BaseCoordinator, AuthorityCoordinator, MemberCoordinator
 from clients import qbittorrent, transmission
-from modules import media_server, schedule
+from modules import media_server, schedule, usenet, data_cap
 
 
 
-if __name__ == '__main__':
-    args = arguments.load_args()
-
-    logger.debug("Loading config")
-
-    if not args.config:
-        logger.critical("No config file specified, use --config_path arg or SPEEDRR_CONFIG env var to specify a config file.")
-        exit()
-
-    cfg = config.load_config(args.config)
-
-    if cfg.logs_path:
-        log_loader.set_file_handler(cfg.logs_path, args.log_file_level)
-    
-    log_loader.stdout_handler.setLevel(args.log_level)
-    
-    logger.info("Starting Speedrr")
-
-    
-    update_event = threading.Event()
-    
-
+def load_clients(cfg: config.SpeedrrConfig) -> List[Union[qbittorrent.qBittorrentClient, transmission.TransmissionClient]]:
     clients: List[Union[qbittorrent.qBittorrentClient, transmission.TransmissionClient]] = []
     for client in cfg.clients:
         if client.type == "qbittorrent":
@@ -38,17 +21,23 @@ if __name__ == '__main__':
 
         elif client.type == "transmission":
             torrent_client = transmission.TransmissionClient(cfg, client)
+            torrent_client.run()
 
         else:
             logger.critical(f"Unknown client type in config: {client.type}")
             exit()
 
         clients.append(torrent_client)
-        
-    sum_client_upload_shares = sum(client.upload_shares for client in cfg.clients)
-    sum_client_download_shares = sum(client.download_shares for client in cfg.clients)
 
-    modules: List[Union[media_server.MediaServerModule, schedule.ScheduleModule]] = []
+    return clients
+
+
+def load_modules(
+    cfg: config.SpeedrrConfig,
+    update_event: threading.Event,
+    clients: List[Union[qbittorrent.qBittorrentClient, transmission.TransmissionClient]]
+) -> List[Union[media_server.MediaServerModule, schedule.ScheduleModule, usenet.UsenetModule, data_cap.DataCapModule]]:
+    modules: List[Union[media_server.MediaServerModule, schedule.ScheduleModule, usenet.UsenetModule, data_cap.DataCapModule]] = []
     if cfg.modules.media_servers:
         plex_module = media_server.MediaServerModule(cfg, cfg.modules.media_servers, update_event)
         modules.append(plex_module)
@@ -56,87 +45,114 @@ if __name__ == '__main__':
     if cfg.modules.schedule:
         schedule_module = schedule.ScheduleModule(cfg, cfg.modules.schedule, update_event)
         modules.append(schedule_module)
-    
 
-    if not modules:
-        logger.critical("No modules enabled in config, exiting")
+    if cfg.modules.usenet:
+        usenet_module = usenet.UsenetModule(cfg, cfg.modules.usenet, update_event)
+        modules.append(usenet_module)
+
+    if cfg.modules.data_cap:
+        data_cap_module = data_cap.DataCapModule(cfg, cfg.modules.data_cap, update_event, clients)
+        modules.append(data_cap_module)
+
+    return modules
+
+
+def load_coordinator(cfg: config.SpeedrrConfig, update_event: threading.Event) -> Optional[BaseCoordinator]:
+    if not cfg.coordinator:
+        return None
+
+    if cfg.coordinator.role == "authority":
+        return AuthorityCoordinator(cfg, cfg.coordinator, update_event)
+
+    elif cfg.coordinator.role == "member":
+        return MemberCoordinator(cfg, cfg.coordinator, update_event)
+
+    logger.critical(f"Unknown coordinator role in config: {cfg.coordinator.role}")
+    exit()
+
+
+
+if __name__ == '__main__':
+    args = arguments.load_args()
+
+    logger.debug("Loading config")
+
+    if not args.config:
+        logger.critical("No config file specified, use --config_path arg or SPEEDRR_CONFIG env var to specify a config file.")
+        exit()
+
+    cfg = config.load_config(args.config)
+
+    if args.query_history is not None:
+        if not cfg.history:
+            logger.critical("History is not enabled in the config, add a history section to use --query_history.")
+            exit()
+
+        try:
+            result = query_server(cfg.history, args.query_history, args.at)
+        except httpx.HTTPError as e:
+            logger.critical(f"Couldn't reach the history on {cfg.history.host}:{cfg.history.port}, is Speedrr running? ({e})")
+            exit()
+        except ValueError:
+            logger.critical("--at must be a unix timestamp, an ISO datetime, or HH:MM.")
+            exit()
+
+        if "error" in result:
+            logger.critical(f"Error from history: {result['error']}")
+        elif "points" in result:
+            for timestamp, value in result["points"]:
+                print(f"{datetime.fromtimestamp(timestamp):%Y-%m-%d %H:%M:%S}  {value}")
+        elif "value" in result:
+            print(result["value"])
+        else:
+            print("\n".join(result["series"]))
         exit()
+
+    if cfg.logs_path:
+        log_loader.set_file_handler(cfg.logs_path, args.log_file_level)
+    
+    log_loader.set_stdout_level(args.log_level)
+    
+    logger.info("Starting Speedrr")
+
+    if cfg.history:
+        history.configure(cfg.history)
+        start_server(cfg.history)
+
     
+    updaters: List[tuple[SpeedUpdater, threading.Event]] = []
+
+    for pool_name, pool_cfg in config.pool_configs(cfg):
+        if pool_name:
+            logger.info(f"Loading pool: {pool_name}")
 
-    for module in modules:
-        module.run()
-        logger.info(f"Started module: {module.__class__.__name__}")
+        update_event = threading.Event()
+        clients = load_clients(pool_cfg)
+        modules = load_modules(pool_cfg, update_event, clients)
 
+        if not modules:
+            logger.critical(f"No modules enabled in config{f' for pool {pool_name}' if pool_name else ''}, exiting")
+            exit()
 
-    # Force an initial update
-    update_event.set()
+        for module in modules:
+            module.run()
+            logger.info(f"Started module: {module.__class__.__name__}")
 
-    while True:
-        # Without a timeout, Ctrl+C won't work.
-        # Polling isn't great, but it will work.
-        event_triggered = update_event.wait(timeout=0.2)
-        if not event_triggered:
-            continue
-        
-        # Clear immediately, so that the next event can be set.
-        update_event.clear()
+        coordinator = load_coordinator(pool_cfg, update_event)
+        if coordinator:
+            coordinator.run()
+            logger.info(f"Started coordinator as {coordinator.__class__.__name__}")
 
-        logger.info("Update event triggered")
+        updaters.append((SpeedUpdater(pool_cfg, modules, clients, name=pool_name, coordinator=coordinator), update_event))
 
-        try:
-            module_reduction_values = [
-                module.get_reduction_value()
-                for module in modules
-            ]
-
-            # These are in the config's units
-            new_upload_speed = max(
-                cfg.min_upload,
-                (cfg.max_upload - sum(module[0] for module in module_reduction_values))
-            )
-
-            new_download_speed = max(
-                cfg.min_download,
-                (cfg.max_download - sum(module[1] for module in module_reduction_values))
-            )
-
-            logger.info(f"New calculated upload speed: {new_upload_speed}{cfg.units}")
-            logger.info(f"New calculated download speed: {new_download_speed}{cfg.units}")
-
-            logger.info("Getting active torrent counts")
-
-            client_active_torrent_dict = {
-                client: client.get_active_torrent_count()
-                for client in clients
-            }
-
-            sum_active_torrents = sum(client_active_torrent_dict.values())
-            
-            for torrent_client, active_torrent_count in client_active_torrent_dict.items():
-                # If there are no active torrents, set the upload speed to the new speed
-                if cfg.manual_speed_algorithm_share:
-                    effective_upload_speed = (torrent_client._client_config.download_shares / sum_client_upload_shares * new_upload_speed)
-                    effective_download_speed = (torrent_client._client_config.upload_shares / sum_client_download_shares * new_download_speed)
-                else: 
-                    effective_upload_speed = (active_torrent_count / sum_active_torrents * new_upload_speed) if active_torrent_count > 0 else new_upload_speed
-                    effective_download_speed = (active_torrent_count / sum_active_torrents * new_download_speed) if active_torrent_count > 0 else new_download_speed
-                try:
-                    torrent_client.set_upload_speed(effective_upload_speed)
-                    torrent_client.set_download_speed(effective_download_speed)
-                
-                except Exception:
-                    logger.warning(f"An error occurred while updating {torrent_client._client_config.url}, skipping:\n" + traceback.format_exc())
-                
-                else:
-                    logger.info(f"Set upload speed for {torrent_client._client_config.url} to {effective_upload_speed}{cfg.units}")
-                    logger.info(f"Set download speed for {torrent_client._client_config.url} to {effective_download_speed}{cfg.units}")
-            
-
-            logger.info("Speeds updated")
-
-
-        except Exception:
-            logger.error("An error occurred while updating clients:\n" + traceback.format_exc())
-        
-
-        logger.info("Waiting for next update event")
+
+    threads = []
+    for updater, update_event in updaters:
+        thread = threading.Thread(target=updater.run, args=(update_event,))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    # Without a timeout, Ctrl+C won't work.
+    while all(thread.is_alive() for thread in threads):
+        threads[0].join(timeout=0.2)
@@ -0,0 +1,194 @@
+import threading
+import json
+import math
+import pathlib
+import traceback
+from datetime import datetime, timezone
+from typing import List, Protocol
+
+from helpers.config import SpeedrrConfig, ClientConfig, DataCapConfig
+from helpers.log_loader import logger
+from helpers.bit_convert import bit_conv
+from helpers.clock import Clock, system_clock
+from helpers.reduction_store import ReductionStore
+
+
+
+class TransferClient(Protocol):
+    _client_config: ClientConfig
+
+    def get_transferred_bytes(self) -> tuple[int, int]: ...
+
+
+
+class DataCapModule:
+    """A module that paces the torrent clients, so their transfer lands just under a data cap by the end of the billing period.
+
+    Each direction with a cap has a token bucket, which fills at the pace that would use up the rest of the budget
+    exactly at the end of the period. While the bucket has tokens, the clients can burst above that pace.
+
+    This is a ceiling on the speeds, not a reduction, so other modules' reductions don't throttle the clients twice.
+    Its store holds the allowed speeds, infinite for a direction without a cap."""
+
+    def __init__(self, config: SpeedrrConfig, module_config: DataCapConfig, update_event: threading.Event, clients: List[TransferClient], clock: Clock = system_clock) -> None:
+        self.reduction_store = ReductionStore()
+
+        self._config = config
+        self._module_config = module_config
+        self._update_event = update_event
+        self._clients = clients
+        self._clock = clock
+
+        self._caps = (
+            bit_conv(module_config.upload_cap, module_config.cap_units, 'B') if module_config.upload_cap else None,
+            bit_conv(module_config.download_cap, module_config.cap_units, 'B') if module_config.download_cap else None,
+        )
+
+        self._period_start, self._period_end = self.billing_period()
+
+        # Bytes used this period, bucket tokens (in bytes), and the last transfer counters seen for each client
+        self._used = [0.0, 0.0]
+        self._tokens = [self.burst_size(0), self.burst_size(1)]
+        self._last_counters: dict[str, tuple[int, int]] = {}
+        self._last_update = self._clock.time()
+
+        self.load_state()
+
+
+    def billing_period(self) -> tuple[float, float]:
+        "The start and end of the current billing period, as timestamps."
+        now = self._clock.now(datetime.now(timezone.utc).astimezone().tzinfo)
+        day = self._module_config.billing_day
+
+        start = now.replace(day=day, hour=0, minute=0, second=0, microsecond=0)
+        if start > now:
+            start = start.replace(year=start.year - 1, month=12) if start.month == 1 else start.replace(month=start.month - 1)
+
+        end = start.replace(year=start.year + 1, month=1) if start.month == 12 else start.replace(month=start.month + 1)
+        return start.timestamp(), end.timestamp()
+
+
+    def burst_size(self, direction: int) -> float:
+        "The size of the token bucket for a direction, in bytes."
+        cap = self._caps[direction]
+        return cap * self._module_config.burst / 100 if cap else 0
+
+
+    def load_state(self) -> None:
+        path = pathlib.Path(self._module_config.state_path)
+        if not path.exists():
+            return
+
+        try:
+            state = json.loads(path.read_text(encoding="utf-8"))
+        except Exception:
+            logger.warning(f"<data_cap> Failed to load state from {path}, starting from 0:\n" + traceback.format_exc())
+            return
+
+        if state["period_start"] != self._period_start:
+            logger.info("<data_cap> Saved state is from a previous billing period, starting from 0")
+            return
+
+        self._used = state["used"]
+        self._tokens = state["tokens"]
+        self._last_counters = {url: tuple(counters) for url, counters in state["last_counters"].items()} # type: ignore
+        logger.info(f"<data_cap> Loaded state, used {self._used[0]}B upload and {self._used[1]}B download this period")
+
+
+    def save_state(self) -> None:
+        path = pathlib.Path(self._module_config.state_path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        tmp_path = path.with_suffix(path.suffix + ".tmp")
+        tmp_path.write_text(json.dumps({
+            "period_start": self._period_start,
+            "used": self._used,
+            "tokens": self._tokens,
+            "last_counters": self._last_counters,
+        }), encoding="utf-8")
+        tmp_path.replace(path)
+
+
+    def get_speed_cap(self) -> tuple[float, float]:
+        "The most the clients can use, in the config's units. Returns a tuple of `(upload, download)`."
+
+        upload, download = self.reduction_store.snapshot.values.get("data_cap", (math.inf, math.inf))
+        logger.info(f"<data_cap> Allowed speeds = upload: {upload}, download: {download}")
+        return upload, download
+
+
+    def update(self) -> None:
+        "Add the bytes transferred since the last update, and recalculate the reduction."
+
+        now = self._clock.time()
+        if now >= self._period_end:
+            logger.info("<data_cap> New billing period started")
+            self._period_start, self._period_end = self.billing_period()
+            self._used = [0.0, 0.0]
+            self._tokens = [self.burst_size(0), self.burst_size(1)]
+
+        transferred = [0, 0]
+        for client in self._clients:
+            counters = client.get_transferred_bytes()
+            last_counters = self._last_counters.get(client._client_config.url)
+
+            for direction in (0, 1):
+                if last_counters is None:
+                    # First time this client is seen, only count from now on
+                    continue
+
+                if counters[direction] < last_counters[direction]:
+                    # The client was restarted, and its counters were reset
+                    transferred[direction] += counters[direction]
+                else:
+                    transferred[direction] += counters[direction] - last_counters[direction]
+
+            self._last_counters[client._client_config.url] = counters
+
+        elapsed = max(0, now - self._last_update)
+        self._last_update = now
+        time_left = max(1, self._period_end - now)
+
+        allowed = [math.inf, math.inf]
+        for direction in (0, 1):
+            self._used[direction] += transferred[direction]
+
+            cap = self._caps[direction]
+            if not cap:
+                continue
+
+            # Keep a small margin, so the cap isn't hit from the clients overshooting between updates
+            budget_left = max(0, cap * (1 - self._module_config.margin / 100) - self._used[direction])
+            pace = budget_left / time_left
+
+            self._tokens[direction] = min(
+                self.burst_size(direction),
+                budget_left,
+                max(0, self._tokens[direction] + pace * elapsed - transferred[direction])
+            )
+
+            # The bucket can be emptied over the next interval, on top of the pace
+            allowed[direction] = bit_conv(pace + self._tokens[direction] / self._module_config.update_interval, 'B', self._config.units)
+
+            logger.debug(f"<data_cap> {('upload', 'download')[direction]}: used {self._used[direction]}B of {cap}B, pace {pace}B/s, tokens {self._tokens[direction]}B")
+
+        self.save_state()
+
+        if self.reduction_store.publish({"data_cap": (allowed[0], allowed[1])}):
+            self._update_event.set()
+
+
+    def run(self) -> None:
+        thread = threading.Thread(target=self.loop)
+        thread.daemon = True
+        thread.start()
+
+
+    def loop(self) -> None:
+        while True:
+            try:
+                self.update()
+            except Exception:
+                logger.error("<data_cap> Error updating data usage:\n" + traceback.format_exc())
+
+            self._clock.sleep(self._module_config.update_interval)
@@ -1,51 +1,153 @@
 import httpx
 import threading
-from typing import Union, List
-import time
+from typing import List, Optional, Union
+from collections import OrderedDict, Counter
 import traceback
 import ipaddress
+from functools import lru_cache
 
 from helpers.config import SpeedrrConfig, MediaServerConfig
 from helpers.log_loader import logger
 from helpers.bit_convert import bit_conv
+from helpers.history import history
+from helpers.clock import Clock, system_clock
+from helpers.reduction_store import ReductionStore
+from helpers.stream_rules import StreamPolicy
+
+
+
+SessionIdentity = tuple[str, ...]
+
+
+@lru_cache(maxsize=1024)
+def parse_ip(address: str) -> Union[ipaddress.IPv4Address, ipaddress.IPv6Address]:
+    "Parse an IP address. Cached, as the same sessions are seen on every poll."
+    return ipaddress.ip_address(address)
+
+
+def session_identity(server_config: MediaServerConfig, session_id: str, ip_address: str, player_id: str, media_id: str) -> SessionIdentity:
+    """A normalized identity for a session, which is the same for every server that reports it.
+    Falls back to an identity unique to the server, if the player or media item is unknown."""
+
+    if not player_id or not media_id:
+        return (server_config.url, session_id)
+
+    try:
+        ip = parse_ip(ip_address)
+        if isinstance(ip, ipaddress.IPv6Address) and ip.ipv4_mapped:
+            ip = ip.ipv4_mapped
+        ip_address = str(ip)
+    except ValueError:
+        ip_address = ip_address.strip().lower()
+
+    return (ip_address, player_id.strip().lower(), str(media_id).strip())
+
+
+
+class SessionIndex:
+    """Every server's sessions, so a session reported by more than one server is only counted once.
+    Each unique session is counted towards a server measuring its bandwidth if there is one, as reserved bandwidth
+    is usually well above what is used, otherwise towards the server reporting the highest bandwidth for it."""
+
+    def __init__(self, reduction_store: ReductionStore) -> None:
+        self._reduction_store = reduction_store
+        self._sessions: dict[MediaServerConfig, dict[SessionIdentity, float]] = {}
+        self._lock = threading.Lock()
+
+
+    def publish(self, server_config: MediaServerConfig, sessions: dict[SessionIdentity, float]) -> bool:
+        "Replace the sessions of a server, with their bandwidth in config units. Returns whether any server's reduction changed."
+
+        with self._lock:
+            self._sessions[server_config] = sessions
+
+            owners: dict[SessionIdentity, tuple[MediaServerConfig, float]] = {}
+            for server, server_sessions in self._sessions.items():
+                for identity, bandwidth in server_sessions.items():
+                    if identity not in owners or self.rank(server, bandwidth) > self.rank(*owners[identity]):
+                        owners[identity] = (server, bandwidth)
+
+            reductions = {server: 0.0 for server in self._sessions}
+            for server, bandwidth in owners.values():
+                reductions[server] += bandwidth
+
+            return self._reduction_store.publish({
+                server: (reduction, 0)
+                for server, reduction in reductions.items()
+            })
+
+
+    @staticmethod
+    def rank(server_config: MediaServerConfig, bandwidth: float) -> tuple[bool, float]:
+        return server_config.bandwidth_mode == "measured", bandwidth
+
+
+
+class BitrateCache:
+    "A bounded cache of the estimated bitrate of each media item, so the streams are only summed once per item."
+
+    def __init__(self, max_size: int = 256) -> None:
+        self._max_size = max_size
+        self._bitrates: OrderedDict[tuple[str, str], int] = OrderedDict()
+
+
+    def get(self, item_id: str, media_source_id: str) -> Optional[int]:
+        bitrate = self._bitrates.get((item_id, media_source_id))
+        if bitrate is not None:
+            self._bitrates.move_to_end((item_id, media_source_id))
+        return bitrate
+
+
+    def set(self, item_id: str, media_source_id: str, bitrate: int) -> None:
+        self._bitrates[(item_id, media_source_id)] = bitrate
+        self._bitrates.move_to_end((item_id, media_source_id))
+
+        if len(self._bitrates) > self._max_size:
+            self._bitrates.popitem(last=False)
 
 
 
 class MediaServerModule:
-    def __init__(self, config: SpeedrrConfig, module_config: List[MediaServerConfig], update_event: threading.Event) -> None:
-        self.reduction_value_dict: dict[MediaServerConfig, float] = {}
+    def __init__(self, config: SpeedrrConfig, module_config: List[MediaServerConfig], update_event: threading.Event, clock: Clock = system_clock) -> None:
+        self.reduction_store = ReductionStore()
+        self.session_index = SessionIndex(self.reduction_store)
+        self.stream_policy = StreamPolicy((config.modules.stream_rules if config.modules else None) or [], config.units)
 
         self._config = config
         self._module_config = module_config
         self._update_event = update_event
+        self._clock = clock
 
-        self.servers: list[Union[PlexServer, TautulliServer, JellyfinServer, EmbyServer]] = []
+        self.servers: list[BaseServer] = []
         
         for server in self._module_config:
-            if server.type == "plex":
-                self.servers.append(PlexServer(config, server, self))
-            
-            elif server.type == "tautulli":
-                self.servers.append(TautulliServer(config, server, self))
-            
-            elif server.type == "jellyfin":
-                self.servers.append(JellyfinServer(config, server, self))
+            self.servers.append(self._create_server(server))
+            self.servers[-1].get_bandwidth()
 
-            elif server.type == "emby":
-                self.servers.append(EmbyServer(config, server, self))
-            
-            else:
-                logger.critical(f"<media_servers> Unknown media server type in config: {server.type}")
-                exit()
 
-            self.servers[-1].get_bandwidth()
+    def _create_server(self, server: MediaServerConfig) -> "BaseServer":
+        if server.type == "plex":
+            return PlexServer(self._config, server, self)
+        
+        elif server.type == "tautulli":
+            return TautulliServer(self._config, server, self)
+        
+        elif server.type == "jellyfin":
+            return JellyfinServer(self._config, server, self)
+
+        elif server.type == "emby":
+            return EmbyServer(self._config, server, self)
+        
+        logger.critical(f"<media_servers> Unknown media server type in config: {server.type}")
+        exit()
 
 
     def get_reduction_value(self) -> tuple[float, float]:
         "How much to reduce the speed by, in the config's units. Returns a tuple of `(upload, download)`."
 
-        logger.info(f"<media_servers> Upload reduction values = {'; '.join(f'{server.url}: {reduction}' for server, reduction in self.reduction_value_dict.items())}")
-        return sum(self.reduction_value_dict.values()), 0
+        snapshot = self.reduction_store.snapshot
+        logger.info(f"<media_servers> Upload reduction values = {'; '.join(f'{server.url}: {reduction[0]}' for server, reduction in snapshot.values.items())}")
+        return snapshot.upload, 0
 
 
     def run(self):
@@ -69,11 +171,16 @@ class BaseServer(threading.Thread):
         )
 
         self._paused_since: dict[str, int] = {}
+        self._sessions: dict[SessionIdentity, int] = {}
+        self._bitrate_cache = BitrateCache()
+
+        # Parsed once, rather than for every session
+        self._ignore_networks = [ipaddress.ip_network(network) for network in self._server_config.ignore_streams.ip_networks or ()]
 
         self._logger_prefix = f"<{self._server_config.type}|{self._server_config.url}>"
 
         # Prevents a duplicate event running at the beginning, if the bandwidth for this server is 0 (and thus will not affect the upload speed).
-        self._module.reduction_value_dict[self._server_config] = 0
+        self._module.session_index.publish(self._server_config, {})
     
 
     def get_bandwidth(self) -> int:
@@ -81,29 +188,71 @@ class BaseServer(threading.Thread):
         raise NotImplementedError("get_bandwidth must be implemented in a subclass")
     
 
-    def set_reduction(self, reduction) -> None:
-        "Set the upload speed reduction for the server, in config units. Accepts Kbit/s as input."
-        reduction = bit_conv(reduction, "Kbit", self._config.units)
-
-        old_reduction = self._module.reduction_value_dict.get(self._server_config)
+    def set_reduction(self) -> None:
+        "Publish the sessions counted in the last poll, and dispatch an update event if the reduction changed."
 
-        if old_reduction == reduction:
-            return
+        sessions = {
+            identity: bit_conv(bandwidth, "Kbit", self._config.units)
+            for identity, bandwidth in self._sessions.items()
+        }
 
-        self._module.reduction_value_dict[self._server_config] = reduction
-        self._module._update_event.set()
+        if self._module.session_index.publish(self._server_config, sessions):
+            self._module._update_event.set()
     
 
-    def process_session(self, bandwidth: int, paused: bool, ip_address: str, session_id: str, title: str) -> int:
-        "Process a session and return the bandwidth usage. Returns 0 if the session should be ignored."
+    def estimate_bitrate(self, session: dict) -> int:
+        "Estimate the bitrate of a direct play/stream session on Jellyfin or Emby from its video and audio streams, in bit/s."
+
+        item = session["NowPlayingItem"]
+        item_id = item.get("Id", "")
+        media_source_id = session["PlayState"].get("MediaSourceId", "")
+
+        bitrate = self._bitrate_cache.get(item_id, media_source_id)
+        if bitrate is not None:
+            return bitrate
+
+        overrides = self._server_config.bitrate_overrides
+        if overrides and item_id in overrides:
+            bitrate = int(bit_conv(overrides[item_id], self._config.units, 'bit'))
+            logger.debug(f"{self._logger_prefix} Using bitrate override for {item['Name']}: {bitrate}bit")
+
+        else:
+            bitrate = sum(
+                int(stream.get("BitRate", 0))
+                for stream in item.get("MediaStreams", [])
+                if stream.get("Type") in ("Video", "Audio")
+            )
+            logger.debug(f"{self._logger_prefix} Estimated bitrate for {item['Name']} from MediaStreams: {bitrate}bit")
+
+        self._bitrate_cache.set(item_id, media_source_id, bitrate)
+        return bitrate
+
+
+    def process_session(
+        self,
+        bandwidth: int,
+        paused: bool,
+        ip_address: str,
+        session_id: str,
+        title: str,
+        player_id: str = "",
+        media_id: str = "",
+        user: str = "",
+        player: str = "",
+        library: str = "",
+        transcode: bool = False
+    ) -> int:
+        """Process a session and return the bandwidth usage, after the bandwidth multiplier and stream rules. Returns 0 if the session should be ignored.
+        Counted sessions are added to the session index on the next `set_reduction`, using the player and media IDs to spot duplicates.
+        The user, player name, library and whether it's transcoding are matched against the stream rules."""
 
         if paused and self._server_config.ignore_streams.paused_after != -1:
             
             if session_id not in self._paused_since:
-                self._paused_since[session_id] = int(time.time())
+                self._paused_since[session_id] = int(self._module._clock.time())
                 logger.debug(f"{self._logger_prefix} {title}:{session_id} is paused, noted time")
             
-            elif int(time.time()) - self._paused_since[session_id] > self._server_config.ignore_streams.paused_after:
+            elif int(self._module._clock.time()) - self._paused_since[session_id] > self._server_config.ignore_streams.paused_after:
                 logger.debug(f"{self._logger_prefix} Removing {title}:{session_id} from count, paused for too long")
                 return 0
         
@@ -113,23 +262,47 @@ class BaseServer(threading.Thread):
                 del self._paused_since[session_id]
         
         local_ip: bool = False
-        
-        if self._server_config.ignore_streams.local:
-            if ip_address == "lan" or ipaddress.ip_address(ip_address).is_private:
+
+        if self._server_config.ignore_streams.local and ip_address == "lan":
+            local_ip = True
+
+        elif self._server_config.ignore_streams.local or self._ignore_networks:
+            ip = parse_ip(ip_address)
+
+            if self._server_config.ignore_streams.local and ip.is_private:
                 local_ip = True
-                
-        if self._server_config.ignore_streams.ip_networks:
-            ip = ipaddress.ip_address(ip_address)
-            networks = (ipaddress.ip_network(network) for network in self._server_config.ignore_streams.ip_networks)
-            if any(ip in network for network in networks):
+
+            elif any(ip in network for network in self._ignore_networks):
                 local_ip = True
 
 
         if local_ip:
             logger.debug(f"{self._logger_prefix} Ignoring local stream {title}:{session_id} ({ip_address})")
             return 0
+
+        # Before the rules, so a cap is the most that is reserved
+        bandwidth = int(bandwidth * self._server_config.bandwidth_multiplier)
+
+        decision = self._module.stream_policy.decide(self._server_config.type, user, player, library, transcode)
+
+        # Lazy arguments from here on, this runs for every session and the messages are only formatted if debug logs are shown
+        if decision is not None:
+            if decision.action == "ignore":
+                logger.debug("%s Ignoring %s:%s, matched stream rule %d", self._logger_prefix, title, session_id, decision.rule + 1)
+                return 0
+
+            elif decision.action == "cap":
+                bandwidth = min(bandwidth, int(decision.value))
+
+            else:
+                bandwidth = int(bandwidth * decision.value)
+
+            logger.debug("%s %s:%s matched stream rule %d (%s)", self._logger_prefix, title, session_id, decision.rule + 1, decision.action)
         
-        logger.debug(f"{self._logger_prefix} Adding {bandwidth} to count for {title}:{session_id}")
+        logger.debug("%s Adding %d to count for %s:%s", self._logger_prefix, bandwidth, title, session_id)
+
+        identity = session_identity(self._server_config, session_id, ip_address, player_id, media_id)
+        self._sessions[identity] = max(bandwidth, self._sessions.get(identity, 0))
         
         return bandwidth
 
@@ -141,20 +314,74 @@ class BaseServer(threading.Thread):
                 del self._paused_since[session_id]
 
 
+    def poll(self) -> None:
+        "Get the bandwidth from the server once, and update the reduction."
+        try:
+            self._sessions = {}
+            bandwidth = self.get_bandwidth()
+        except Exception:
+            logger.error(f"{self._logger_prefix} Error getting bandwidth:\n" + traceback.format_exc())
+        else:
+            history.record(f"server.{self._server_config.url}.bandwidth", bit_conv(bandwidth, "Kbit", self._config.units), self._module._clock.time())
+            self.set_reduction()
+
+
     def run(self) -> None:
         while True:
-            try:
-                bandwidth = int(self.get_bandwidth() * self._server_config.bandwidth_multiplier)
-            except Exception:
-                logger.error(f"{self._logger_prefix} Error getting bandwidth:\n" + traceback.format_exc())
-            else:
-                self.set_reduction(bandwidth)
-            
-            time.sleep(self._server_config.update_interval)
+            self.poll()
+            self._module._clock.sleep(self._server_config.update_interval)
 
 
 
 class PlexServer(BaseServer):
+    # How far back to look in the bandwidth statistics, in seconds, when the bandwidth mode is "measured"
+    MEASURED_WINDOW = 30
+
+    def __init__(self, config: SpeedrrConfig, server_config: MediaServerConfig, module: MediaServerModule) -> None:
+        # When each session was first seen, so new sessions use the reserved bandwidth until there are enough statistics
+        self._first_seen: dict[str, float] = {}
+
+        super().__init__(config, server_config, module)
+
+
+    def get_measured_bandwidth(self) -> dict[str, float]:
+        "Get the bandwidth each player actually used over the last `MEASURED_WINDOW` seconds, from Plex's bandwidth statistics, in Kbit/s."
+
+        logger.debug(f"{self._logger_prefix} Getting bandwidth statistics")
+
+        res = self._client.get("/statistics/bandwidth", params={"timespan": 6, "X-Plex-Token": self._server_config.token}, headers={"Accept": "application/json"})
+
+        logger.debug(f"{self._logger_prefix} Got {res.status_code} response from Plex")
+
+        res.raise_for_status()
+
+        res_json: dict = res.json()
+        if "MediaContainer" not in res_json:
+            raise Exception(f"Error from Plex: {res_json}")
+
+        container = res_json["MediaContainer"]
+        statistics = container.get("StatisticsBandwidth", [])
+        if not statistics:
+            return {}
+
+        # Statistics use device IDs local to the server, the sessions use the player's client identifier
+        devices = {device["id"]: device.get("clientIdentifier", "") for device in container.get("Device", [])}
+
+        # Relative to the newest entry, so the server's clock doesn't need to match ours
+        since = max(entry["at"] for entry in statistics) - self.MEASURED_WINDOW
+
+        used_bytes: dict[str, int] = {}
+        for entry in statistics:
+            player_id = devices.get(entry["deviceID"])
+            if player_id and entry["at"] > since:
+                used_bytes[player_id] = used_bytes.get(player_id, 0) + int(entry["bytes"])
+
+        return {
+            player_id: bit_conv(bytes_used / self.MEASURED_WINDOW, 'B', 'Kbit')
+            for player_id, bytes_used in used_bytes.items()
+        }
+
+
     def get_bandwidth(self) -> int:
         "Get the current bandwidth usage from Plex, in Kbit/s."
 
@@ -172,24 +399,60 @@ class PlexServer(BaseServer):
         
         if res_json["MediaContainer"]["size"] == 0:
             logger.debug(f"{self._logger_prefix} No sessions found")
+            self._first_seen.clear()
             return 0
         
+        measured = self._server_config.bandwidth_mode == "measured"
+        measured_bandwidth: dict[str, float] = {}
+
+        if measured:
+            # Only the owner's token can read the statistics, and older servers don't have them
+            try:
+                measured_bandwidth = self.get_measured_bandwidth()
+            except Exception:
+                logger.warning(f"{self._logger_prefix} Error getting bandwidth statistics, using reserved bandwidth:\n" + traceback.format_exc())
+        now = self._module._clock.time()
+
+        # Sessions sharing a player split what it used
+        player_sessions = Counter(session["Player"].get("machineIdentifier", "") for session in res_json["MediaContainer"]["Metadata"])
+
         count = 0
         session_ids: list[str] = []
 
         for session in res_json["MediaContainer"]["Metadata"]:
             session_ids.append(session["Session"]["id"])
-            
+
+            bandwidth = int(session["Session"]["bandwidth"])
+
+            if measured:
+                first_seen = self._first_seen.setdefault(session["Session"]["id"], now)
+                player_id = session["Player"].get("machineIdentifier", "")
+
+                if now - first_seen < self.MEASURED_WINDOW or player_id not in measured_bandwidth:
+                    logger.debug(f"{self._logger_prefix} {session['title']}:{session['Session']['id']} is new or has no statistics, using reserved bandwidth")
+                else:
+                    bandwidth = int(round(measured_bandwidth[player_id] / player_sessions[player_id], 0))
+
             count += self.process_session(
-                bandwidth   = int(session["Session"]["bandwidth"]),
+                bandwidth   = bandwidth,
                 paused      = session["Player"]["state"] == "paused",
                 ip_address  = session["Player"]["address"],
                 session_id  = session["Session"]["id"],
-                title       = session["title"]
+                title       = session["title"],
+                player_id   = session["Player"].get("machineIdentifier", ""),
+                media_id    = session.get("ratingKey", ""),
+                user        = session.get("User", {}).get("title", ""),
+                player      = session["Player"].get("title", ""),
+                library     = session.get("librarySectionTitle", ""),
+                transcode   = session.get("TranscodeSession", {}).get("videoDecision") == "transcode"
             )
         
         self.remove_old_paused(session_ids)
 
+        for session_id in self._first_seen.copy():
+            if session_id not in session_ids:
+                del self._first_seen[session_id]
+
         return count
 
 
@@ -216,12 +479,24 @@ class TautulliServer(BaseServer):
         for session in res_json["response"]["data"]["sessions"]:
             session_ids.append(session["session_id"])
 
+            bandwidth = int(session["bandwidth"])
+
+            # The bitrate of the stream being sent, rather than what Plex reserves for it
+            if self._server_config.bandwidth_mode == "measured" and session.get("stream_bitrate"):
+                bandwidth = int(session["stream_bitrate"])
+
             count += self.process_session(
-                bandwidth   = int(session["bandwidth"]),
+                bandwidth   = bandwidth,
                 paused      = session["state"] == "paused",
                 ip_address  = session["ip_address"],
                 session_id  = session["session_id"],
-                title       = session["full_title"]
+                title       = session["full_title"],
+                player_id   = session.get("machine_id", ""),
+                media_id    = session.get("rating_key", ""),
+                user        = session.get("user", ""),
+                player      = session.get("player", ""),
+                library     = session.get("library_name", ""),
+                transcode   = session.get("transcode_decision") == "transcode"
             )
         
         self.remove_old_paused(session_ids)
@@ -252,26 +527,29 @@ class JellyfinServer(BaseServer):
                 session_ids.append(session["Id"])
 
                 if session["PlayState"]["PlayMethod"] in ["DirectPlay", "DirectStream"]:
-                    logger.debug(f"{self._logger_prefix} {session['Id']} is direct play, calculating estimated bandwidth from MediaStreams")
+                    logger.debug(f"{self._logger_prefix} {session['Id']} is direct play, using estimated bandwidth")
                     
-                    bandwidth = 0
-                    for stream in session["NowPlayingItem"]["MediaStreams"]:
-                        bandwidth += int(stream.get("BitRate", 0))
+                    bandwidth = self.estimate_bitrate(session)
                 
                 else:
                     bandwidth = int(session["TranscodingInfo"]["Bitrate"])
 
                 count += self.process_session(
-                    bandwidth   = bandwidth,
+                    bandwidth   = int(round(bit_conv(bandwidth, 'bit', 'Kbit'), 0)),
                     paused      = session["PlayState"]["IsPaused"],
                     ip_address  = session["RemoteEndPoint"],
                     session_id  = session["Id"],
-                    title       = session["NowPlayingItem"]["Name"]
+                    title       = session["NowPlayingItem"]["Name"],
+                    player_id   = session.get("DeviceId", ""),
+                    media_id    = session["NowPlayingItem"].get("Id", ""),
+                    user        = session.get("UserName", ""),
+                    player      = session.get("DeviceName", ""),
+                    transcode   = session["PlayState"]["PlayMethod"] == "Transcode"
                 )
 
         self.remove_old_paused(session_ids)
 
-        return int(round(bit_conv(count, 'bit', 'Kbit'), 0))
+        return count
 
 class EmbyServer(BaseServer):
     def get_bandwidth(self) -> int:
@@ -298,21 +576,24 @@ class EmbyServer(BaseServer):
                     bandwidth = int(session["TranscodingInfo"]["Bitrate"])
 
                 else:
-                    logger.debug(f"{self._logger_prefix} {session['Id']} is direct play or direct stream, calculating estimated bandwidth from MediaStreams")
+                    logger.debug(f"{self._logger_prefix} {session['Id']} is direct play or direct stream, using estimated bandwidth")
 
-                    bandwidth = 0
-                    for stream in session["NowPlayingItem"]["MediaStreams"]:
-                        bandwidth += int(stream.get("BitRate", 0))
+                    bandwidth = self.estimate_bitrate(session)
 
                 count += self.process_session(
-                    bandwidth   = bandwidth,
+                    bandwidth   = int(round(bit_conv(bandwidth, 'bit', 'Kbit'), 0)),
                     paused      = session["PlayState"]["IsPaused"],
                     ip_address  = session["RemoteEndPoint"],
                     session_id  = session["Id"],
-                    title       = session["NowPlayingItem"]["Name"]
+                    title       = session["NowPlayingItem"]["Name"],
+                    player_id   = session.get("DeviceId", ""),
+                    media_id    = session["NowPlayingItem"].get("Id", ""),
+                    user        = session.get("UserName", ""),
+                    player      = session.get("DeviceName", ""),
+                    transcode   = session["PlayState"]["PlayMethod"] == "Transcode"
                 )
 
         self.remove_old_paused(session_ids)
 
-        return int(round(bit_conv(count, 'bit', 'Kbit'), 0))
+        return count
 
@@ -1,42 +1,46 @@
 import threading
 from typing import List
 from datetime import datetime, timezone, timedelta, time
-from time import sleep
 
 from helpers.config import SpeedrrConfig, ScheduleConfig
 from helpers.log_loader import logger
+from helpers.clock import Clock, system_clock
+from helpers.reduction_store import ReductionStore
 
 
 
 class ScheduleModule:
     "A module that manages schedules."
 
-    def __init__(self, config: SpeedrrConfig, module_configs: List[ScheduleConfig], update_event: threading.Event) -> None:
-        self.reduction_value_dict: dict[ScheduleConfig, tuple[float, float]] = {}
+    def __init__(self, config: SpeedrrConfig, module_configs: List[ScheduleConfig], update_event: threading.Event, clock: Clock = system_clock) -> None:
+        self.reduction_store = ReductionStore()
 
         self._config = config
         self._module_configs = module_configs
         self._update_event = update_event
+        self._clock = clock
+
+        self.threads = [
+            ScheduleThread(module_config, self)
+            for module_config in self._module_configs
+        ]
     
     
     def get_reduction_value(self) -> tuple[float, float]:
         "How much to reduce the speed by, in the config's units. Returns a tuple of `(upload, download)`."
 
-        logger.info(f"<schedule> Upload reduction values = {'; '.join(f'{cfg.start}-{cfg.end}: {reduction[0]}' for cfg, reduction in self.reduction_value_dict.items())}")
-        logger.info(f"<schedule> Download reduction values = {'; '.join(f'{cfg.start}-{cfg.end}: {reduction[1]}' for cfg, reduction in self.reduction_value_dict.items())}")
+        snapshot = self.reduction_store.snapshot
+        logger.info(f"<schedule> Upload reduction values = {'; '.join(f'{cfg.start}-{cfg.end}: {reduction[0]}' for cfg, reduction in snapshot.values.items())}")
+        logger.info(f"<schedule> Download reduction values = {'; '.join(f'{cfg.start}-{cfg.end}: {reduction[1]}' for cfg, reduction in snapshot.values.items())}")
         
-        return (
-            sum([reduction[0] for reduction in self.reduction_value_dict.values()]),
-            sum([reduction[1] for reduction in self.reduction_value_dict.values()]),
-        )
+        return snapshot.upload, snapshot.download
     
 
     def run(self) -> None:
         "Start the schedule threads."
 
         logger.debug("<schedule> Starting schedule module threads")
-        for module_config in self._module_configs:
-            thread = ScheduleThread(module_config, self)
+        for thread in self.threads:
             thread.daemon = True
             thread.start()
 
@@ -77,7 +81,7 @@ class ScheduleThread(threading.Thread):
 
     
     def calculate_next_occurrence(self, hour: int, minute: int) -> datetime:
-        now = datetime.now(self.timezone)
+        now = self._module._clock.now(self.timezone)
         today = now.date()
         
         for day_offset in range(8):  # Search up to 7 days ahead
@@ -94,51 +98,45 @@ class ScheduleThread(threading.Thread):
     def set_reduction(self):
         "Set the reduction value for the module, and dispatches an update event."
 
-        reduction_value = self._module.reduction_value_dict.get(self._config)
-        if reduction_value == (self._upload_reduce_by, self._download_reduce_by):
-            return
-
-        self._module.reduction_value_dict[self._config] = (self._upload_reduce_by, self._download_reduce_by)
-        self._module._update_event.set()
+        if self._module.reduction_store.publish({self._config: (self._upload_reduce_by, self._download_reduce_by)}):
+            self._module._update_event.set()
 
 
     def remove_reduction(self):
         "Remove the reduction value for the module, and dispatches an update event."
 
-        reduction_value = self._module.reduction_value_dict.get(self._config)
-        if reduction_value is None:
-            return
-
-        self._module.reduction_value_dict.pop(self._config)
-        self._module._update_event.set()
+        if self._module.reduction_store.remove(self._config):
+            self._module._update_event.set()
 
     
+    def update(self) -> datetime:
+        "Set or remove the reduction for the current time. Returns when the schedule next changes."
+
+        next_start_occurrence = self.calculate_next_occurrence(self._start_hour, self._start_minute)
+        next_end_occurrence = self.calculate_next_occurrence(self._end_hour, self._end_minute)
+        
+        logger.debug(f"<ScheduleThread> Next start occurrence: {next_start_occurrence}, Next end occurrence: {next_end_occurrence}")
+
+        if next_start_occurrence > next_end_occurrence:
+            # currently between the start and end time
+            self.set_reduction()
+            return next_end_occurrence
+        
+        elif next_start_occurrence < next_end_occurrence:
+            # currently outside the start and end time
+            self.remove_reduction()
+            return next_start_occurrence
+        
+        # start and end time are the same
+        logger.debug("<ScheduleThread> start=end?")
+        raise Exception("Start and end time are the same, this is forbidden.")
+
+
     def run(self) -> None:
         while True:
-            next_start_occurrence = self.calculate_next_occurrence(self._start_hour, self._start_minute)
-            next_end_occurrence = self.calculate_next_occurrence(self._end_hour, self._end_minute)
-            
-            logger.debug(f"<ScheduleThread> Next start occurrence: {next_start_occurrence}, Next end occurrence: {next_end_occurrence}")
-
-            if next_start_occurrence > next_end_occurrence:
-                # currently between the start and end time
-                self.set_reduction()
-
-                sleeping_time = (next_end_occurrence - datetime.now(tz=self.timezone)).total_seconds()
-                logger.debug(f"<ScheduleThread> start>end, Sleeping for {sleeping_time} seconds")
-
-                sleep(sleeping_time)
-            
-            elif next_start_occurrence < next_end_occurrence:
-                # currently outside the start and end time
-                self.remove_reduction()
-
-                sleeping_time = (next_start_occurrence - datetime.now(tz=self.timezone)).total_seconds()
-                logger.debug(f"<ScheduleThread> start<end, Sleeping for {sleeping_time} seconds")
-
-                sleep(sleeping_time)
-            
-            else:
-                # start and end time are the same
-                logger.debug("<ScheduleThread> start=end?")
-                raise Exception("Start and end time are the same, this is forbidden.")
+            next_occurrence = self.update()
+
+            sleeping_time = (next_occurrence - self._module._clock.now(tz=self.timezone)).total_seconds()
+            logger.debug(f"<ScheduleThread> Sleeping for {sleeping_time} seconds")
+
+            self._module._clock.sleep(sleeping_time)
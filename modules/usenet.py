@@ -0,0 +1,152 @@
+import httpx
+import threading
+from typing import List
+import traceback
+
+from helpers.config import SpeedrrConfig, UsenetConfig
+from helpers.log_loader import logger
+from helpers.clock import Clock, system_clock
+from helpers.reduction_store import ReductionStore
+
+
+
+class UsenetModule:
+    "A module that reserves download speed while a Usenet downloader is downloading."
+
+    def __init__(self, config: SpeedrrConfig, module_configs: List[UsenetConfig], update_event: threading.Event, clock: Clock = system_clock) -> None:
+        self.reduction_store = ReductionStore()
+
+        self._config = config
+        self._module_configs = module_configs
+        self._update_event = update_event
+        self._clock = clock
+
+        self.downloaders: list[BaseDownloader] = []
+
+        for downloader in self._module_configs:
+            self.downloaders.append(self._create_downloader(downloader))
+
+
+    def _create_downloader(self, downloader: UsenetConfig) -> "BaseDownloader":
+        if downloader.type == "sabnzbd":
+            return SABnzbdDownloader(self._config, downloader, self)
+
+        elif downloader.type == "nzbget":
+            return NZBGetDownloader(self._config, downloader, self)
+
+        logger.critical(f"<usenet> Unknown usenet downloader type in config: {downloader.type}")
+        exit()
+
+
+    def get_reduction_value(self) -> tuple[float, float]:
+        "How much to reduce the speed by, in the config's units. Returns a tuple of `(upload, download)`."
+
+        snapshot = self.reduction_store.snapshot
+        logger.info(f"<usenet> Download reduction values = {'; '.join(f'{downloader.url}: {reduction[1]}' for downloader, reduction in snapshot.values.items())}")
+        return 0, snapshot.download
+
+
+    def run(self) -> None:
+        for downloader in self.downloaders:
+            downloader.daemon = True
+            downloader.start()
+
+
+
+class BaseDownloader(threading.Thread):
+    def __init__(self, config: SpeedrrConfig, downloader_config: UsenetConfig, module: UsenetModule) -> None:
+        threading.Thread.__init__(self)
+
+        self._config = config
+        self._downloader_config = downloader_config
+        self._module = module
+
+        self._client = httpx.Client(
+            base_url=self._downloader_config.url,
+            verify=self._downloader_config.https_verify
+        )
+
+        self._logger_prefix = f"<{self._downloader_config.type}|{self._downloader_config.url}>"
+
+        if isinstance(self._downloader_config.download, str):
+            self._download_reduce_by = int(self._downloader_config.download[:-1]) / 100 * self._config.max_download
+        else:
+            self._download_reduce_by = self._downloader_config.download
+
+        # Prevents a duplicate event running at the beginning, if the downloader is idle.
+        self._module.reduction_store.publish({self._downloader_config: (0, 0)})
+
+
+    def is_downloading(self) -> bool:
+        "Whether the downloader is currently downloading."
+        raise NotImplementedError("is_downloading must be implemented in a subclass")
+
+
+    def set_reduction(self, reduction: float) -> None:
+        "Set the download speed reduction for the downloader, in config units."
+
+        if self._module.reduction_store.publish({self._downloader_config: (0, reduction)}):
+            self._module._update_event.set()
+
+
+    def poll(self) -> None:
+        "Check the downloader's queue once, and update the reduction."
+        try:
+            downloading = self.is_downloading()
+        except Exception:
+            logger.error(f"{self._logger_prefix} Error getting queue status:\n" + traceback.format_exc())
+        else:
+            logger.debug(f"{self._logger_prefix} Downloading: {downloading}")
+            self.set_reduction(self._download_reduce_by if downloading else 0)
+
+
+    def run(self) -> None:
+        while True:
+            self.poll()
+            self._module._clock.sleep(self._downloader_config.update_interval)
+
+
+
+class SABnzbdDownloader(BaseDownloader):
+    def is_downloading(self) -> bool:
+        "Whether SABnzbd has anything in its queue, and isn't paused."
+
+        logger.debug(f"{self._logger_prefix} Getting queue status")
+
+        res = self._client.get("/api", params={"mode": "queue", "output": "json", "limit": 0, "apikey": self._downloader_config.api_key})
+
+        logger.debug(f"{self._logger_prefix} Got {res.status_code} response from SABnzbd")
+
+        res.raise_for_status()
+
+        res_json: dict = res.json()
+        if "queue" not in res_json:
+            raise Exception(f"Error from SABnzbd: {res_json}")
+
+        queue = res_json["queue"]
+        return not queue["paused"] and int(queue["noofslots"]) > 0
+
+
+
+class NZBGetDownloader(BaseDownloader):
+    def is_downloading(self) -> bool:
+        "Whether NZBGet has anything left to download, and isn't paused."
+
+        logger.debug(f"{self._logger_prefix} Getting queue status")
+
+        res = self._client.post(
+            "/jsonrpc",
+            json={"method": "status", "params": []},
+            auth=(self._downloader_config.username or "", self._downloader_config.password or "")
+        )
+
+        logger.debug(f"{self._logger_prefix} Got {res.status_code} response from NZBGet")
+
+        res.raise_for_status()
+
+        res_json: dict = res.json()
+        if "result" not in res_json:
+            raise Exception(f"Error from NZBGet: {res_json}")
+
+        status = res_json["result"]
+        return not status["DownloadPaused"] and int(status["RemainingSizeMB"]) > 0
@@ -0,0 +1,425 @@
+import threading
+import random
+import time
+from datetime import datetime, timedelta
+from typing import Union, List, Optional
+import yaml
+
+from helpers.log_loader import logger
+from helpers import arguments, config, log_loader
+from helpers.config import SpeedrrConfig, ClientConfig, MediaServerConfig, UsenetConfig
+from helpers.clock import VirtualClock
+from helpers.updater import SpeedUpdater
+from helpers.bit_convert import bit_conv
+from modules import media_server, schedule, usenet, data_cap
+
+
+
+class TraceServer(media_server.BaseServer):
+    "A media server whose sessions are played back from a trace."
+
+    def __init__(self, config: SpeedrrConfig, server_config: MediaServerConfig, module: media_server.MediaServerModule) -> None:
+        self.sessions: dict[str, dict] = {}
+        super().__init__(config, server_config, module)
+
+
+    def get_bandwidth(self) -> int:
+        "Get the current bandwidth usage from the trace, in Kbit/s."
+
+        count = 0
+        for session_id, session in self.sessions.items():
+            count += self.process_session(
+                bandwidth   = int(session["bandwidth"]),
+                paused      = session.get("paused", False),
+                ip_address  = session.get("ip_address", "1.1.1.1"),
+                session_id  = session_id,
+                title       = session.get("title", session_id),
+                player_id   = session.get("player", ""),
+                media_id    = session.get("media", ""),
+                user        = session.get("user", ""),
+                player      = session.get("player_name", ""),
+                library     = session.get("library", ""),
+                transcode   = session.get("transcode", False)
+            )
+
+        self.remove_old_paused(list(self.sessions))
+
+        return count
+
+
+
+class TraceMediaServerModule(media_server.MediaServerModule):
+    "The media server module, using servers played back from a trace."
+
+    def _create_server(self, server: MediaServerConfig) -> media_server.BaseServer:
+        return TraceServer(self._config, server, self)
+
+
+
+class TraceDownloader(usenet.BaseDownloader):
+    "A Usenet downloader whose queue is played back from a trace."
+
+    def __init__(self, config: SpeedrrConfig, downloader_config: UsenetConfig, module: usenet.UsenetModule) -> None:
+        self.downloading = False
+        super().__init__(config, downloader_config, module)
+
+
+    def is_downloading(self) -> bool:
+        return self.downloading
+
+
+
+class TraceUsenetModule(usenet.UsenetModule):
+    "The Usenet module, using downloaders played back from a trace."
+
+    def _create_downloader(self, downloader: UsenetConfig) -> usenet.BaseDownloader:
+        return TraceDownloader(self._config, downloader, self)
+
+
+
+class TraceDataCapModule(data_cap.DataCapModule):
+    "The data cap module, without loading or saving its state, so simulations don't touch the real state file."
+
+    def load_state(self) -> None:
+        pass
+
+
+    def save_state(self) -> None:
+        pass
+
+
+
+class TraceClient:
+    "A torrent client whose activity is played back from a trace, and that counts the limits set on it."
+
+    def __init__(self, config: SpeedrrConfig, config_client: ClientConfig) -> None:
+        self._config = config
+        self._client_config = config_client
+
+        self.active_torrents = 0
+        self.upload_speed: Optional[float] = None
+        self.download_speed: Optional[float] = None
+        self.writes = 0
+
+        # Bytes transferred, assuming an active client uses its whole limit
+        self.transferred = [0.0, 0.0]
+
+
+    def transfer(self, seconds: float) -> None:
+        "Add what the client transferred over `seconds` at its current limits."
+        if self.active_torrents > 0:
+            self.transferred[0] += bit_conv(self.upload_speed or 0, self._config.units, 'B') * seconds
+            self.transferred[1] += bit_conv(self.download_speed or 0, self._config.units, 'B') * seconds
+
+
+    def get_transferred_bytes(self) -> tuple[int, int]:
+        return int(self.transferred[0]), int(self.transferred[1])
+
+
+    def get_active_torrent_count(self) -> int:
+        return self.active_torrents
+
+
+    def set_upload_speed(self, speed: Union[int, float]) -> None:
+        self.upload_speed = speed
+        self.writes += 1
+
+
+    def set_download_speed(self, speed: Union[int, float]) -> None:
+        self.download_speed = speed
+        self.writes += 1
+
+
+
+def load_trace(path: str) -> dict:
+    """Load a trace file. A trace looks like:
+
+    ```yaml
+    start: 2024-05-01T18:00:00  # optional, defaults to now
+    duration: 21600             # seconds to simulate
+    uplink: 20                  # optional, upload capacity in config units, defaults to max_upload
+                                # with pools, use a mapping of pool name to capacity instead
+    events:
+      - at: 0                   # seconds since start
+        client: <client_url>
+        active_torrents: 12
+      - at: 30
+        server: <server_url>
+        session: abc            # sessions are created on first use, and updated by later events
+        bandwidth: 8000         # Kbit/s, as reported by the server
+        actual: 6000            # optional, Kbit/s really used, defaults to bandwidth
+        ip_address: 1.2.3.4
+        player: abc123          # optional, player and media IDs are used to find the same session on several servers
+        media: 4567
+        user: alice             # optional, user, player name, library and transcode are matched against the stream rules
+        player_name: Living Room TV
+        library: Movies 4K
+        transcode: false
+        paused: false
+      - at: 900
+        server: <server_url>
+        session: abc
+        stopped: true
+      - at: 1200
+        downloader: <downloader_url>
+        downloading: true       # whether the Usenet downloader has anything in its queue
+    ```
+    """
+    with open(path, encoding="utf-8") as file:
+        trace = yaml.safe_load(file)
+
+    trace["events"] = sorted(trace.get("events") or [], key=lambda event: event["at"])
+    return trace
+
+
+def generate_trace(cfg: SpeedrrConfig, duration: int, seed: Optional[int] = None) -> dict:
+    "Generate a random trace of streams and torrent activity for the servers and clients in the config."
+    rng = random.Random(seed)
+    events: List[dict] = []
+
+    clients = [client for _, pool_cfg in config.pool_configs(cfg) for client in pool_cfg.clients]
+    servers = [server for _, pool_cfg in config.pool_configs(cfg) for server in pool_cfg.modules.media_servers or []]
+    downloaders = [downloader for _, pool_cfg in config.pool_configs(cfg) for downloader in pool_cfg.modules.usenet or []]
+
+    for client in clients:
+        at = 0
+        while at < duration:
+            events.append({"at": at, "client": client.url, "active_torrents": rng.randint(0, 50)})
+            at += rng.randint(60, 1800)
+
+    for server in servers:
+        at = rng.expovariate(1 / 900)
+        session = 0
+        while at < duration:
+            session_id = f"synthetic-{session}"
+            bandwidth = rng.choice([2000, 4000, 8000, 12000, 20000, 40000])
+            length = rng.randint(20 * 60, 150 * 60)
+
+            events.append({
+                "at": at,
+                "server": server.url,
+                "session": session_id,
+                "bandwidth": bandwidth,
+                "actual": int(bandwidth * rng.uniform(0.4, 1.0)),
+                "ip_address": f"81.2.69.{rng.randint(1, 254)}",
+            })
+
+            if rng.random() < 0.3:
+                pause_at = at + rng.uniform(0, length / 2)
+                events.append({"at": pause_at, "server": server.url, "session": session_id, "paused": True})
+                events.append({"at": min(pause_at + rng.randint(30, 900), at + length - 1), "server": server.url, "session": session_id, "paused": False})
+
+            events.append({"at": at + length, "server": server.url, "session": session_id, "stopped": True})
+
+            at += rng.expovariate(1 / 900)
+            session += 1
+
+    for downloader in downloaders:
+        at = rng.expovariate(1 / 3600)
+        while at < duration:
+            events.append({"at": at, "downloader": downloader.url, "downloading": True})
+            at += rng.randint(5 * 60, 90 * 60)
+            events.append({"at": at, "downloader": downloader.url, "downloading": False})
+            at += rng.expovariate(1 / 3600)
+
+    events.sort(key=lambda event: event["at"])
+    return {"duration": duration, "events": events}
+
+
+
+class Simulation:
+    "Replays a trace through the real modules and speed updater, on a virtual clock."
+
+    def __init__(self, cfg: SpeedrrConfig, trace: dict, name: Optional[str] = None) -> None:
+        self._config = cfg
+        self._trace = trace
+        self.name = name
+
+        start = trace.get("start") or datetime.now().replace(microsecond=0)
+        if isinstance(start, str):
+            start = datetime.fromisoformat(start)
+
+        self.start = start.timestamp()
+        self.end = self.start + trace["duration"]
+        self.uplink = trace.get("uplink", cfg.max_upload)
+        if isinstance(self.uplink, dict):
+            self.uplink = self.uplink.get(name, cfg.max_upload)
+        self.clock = VirtualClock(self.start)
+        self.update_event = threading.Event()
+
+        self.clients = {client.url: TraceClient(cfg, client) for client in cfg.clients}
+
+        self.modules: List[Union[TraceMediaServerModule, schedule.ScheduleModule, TraceUsenetModule, TraceDataCapModule]] = []
+        self.servers: dict[str, TraceServer] = {}
+        self.schedules: List[schedule.ScheduleThread] = []
+        self.downloaders: dict[str, TraceDownloader] = {}
+
+        if cfg.modules.media_servers:
+            media_server_module = TraceMediaServerModule(cfg, cfg.modules.media_servers, self.update_event, self.clock)
+            self.servers = {server._server_config.url: server for server in media_server_module.servers} # type: ignore
+            self.modules.append(media_server_module)
+
+        if cfg.modules.schedule:
+            schedule_module = schedule.ScheduleModule(cfg, cfg.modules.schedule, self.update_event, self.clock)
+            self.schedules = schedule_module.threads
+            self.modules.append(schedule_module)
+
+        if cfg.modules.usenet:
+            usenet_module = TraceUsenetModule(cfg, cfg.modules.usenet, self.update_event, self.clock)
+            self.downloaders = {downloader._downloader_config.url: downloader for downloader in usenet_module.downloaders} # type: ignore
+            self.modules.append(usenet_module)
+
+        self.data_cap: Optional[TraceDataCapModule] = None
+        if cfg.modules.data_cap:
+            self.data_cap = TraceDataCapModule(cfg, cfg.modules.data_cap, self.update_event, list(self.clients.values()), self.clock) # type: ignore
+            self.modules.append(self.data_cap)
+
+        self.updater = SpeedUpdater(cfg, self.modules, list(self.clients.values()), self.clock, name)
+
+        self.timeline: List[tuple[float, str, float, float]] = []
+        self.oversubscribed_seconds = 0.0
+
+
+    def apply_event(self, event: dict) -> None:
+        "Apply an event from the trace, events for clients, servers and downloaders in other pools are ignored."
+        if "client" in event:
+            if event["client"] in self.clients:
+                self.clients[event["client"]].active_torrents = event["active_torrents"]
+            return
+
+        if "downloader" in event:
+            if event["downloader"] in self.downloaders:
+                self.downloaders[event["downloader"]].downloading = event["downloading"]
+            return
+
+        if event["server"] not in self.servers:
+            return
+
+        sessions = self.servers[event["server"]].sessions
+        if event.get("stopped"):
+            sessions.pop(event["session"], None)
+            return
+
+        if event["session"] not in sessions and "bandwidth" not in event:
+            logger.warning(f"<simulate> Ignoring event at {event['at']}, session {event['session']} has no bandwidth")
+            return
+
+        session = sessions.setdefault(event["session"], {})
+        session.update({key: value for key, value in event.items() if key not in ("at", "server", "session")})
+
+
+    def uplink_usage(self) -> float:
+        "Upload used by the active clients and playing streams, in config units."
+        usage = sum(
+            client.upload_speed or 0
+            for client in self.clients.values()
+            if client.active_torrents > 0
+        )
+
+        for server in self.servers.values():
+            for session in server.sessions.values():
+                if not session.get("paused"):
+                    usage += bit_conv(session.get("actual", session["bandwidth"]), "Kbit", self._config.units)
+
+        return usage
+
+
+    def run(self) -> dict:
+        events = self._trace["events"]
+        event_index = 0
+
+        next_poll: dict[Union[TraceServer, TraceDownloader], float] = {server: self.start for server in self.servers.values()}
+        next_poll.update({downloader: self.start for downloader in self.downloaders.values()})
+        next_data_cap = self.start if self.data_cap else self.end
+        next_schedule = {thread: self.start for thread in self.schedules}
+
+        # Same as main.py, force an initial update
+        self.update_event.set()
+
+        while True:
+            now = self.clock.time()
+
+            while event_index < len(events) and self.start + events[event_index]["at"] <= now:
+                self.apply_event(events[event_index])
+                event_index += 1
+
+            for poller, poll_time in next_poll.items():
+                if poll_time <= now:
+                    poller.poll()
+                    interval = poller._server_config.update_interval if isinstance(poller, TraceServer) else poller._downloader_config.update_interval
+                    next_poll[poller] = now + max(1, interval)
+
+            if self.data_cap and next_data_cap <= now:
+                self.data_cap.update()
+                next_data_cap = now + max(1, self.data_cap._module_config.update_interval)
+
+            for thread, schedule_time in next_schedule.items():
+                if schedule_time <= now:
+                    next_schedule[thread] = thread.update().timestamp()
+
+            if self.update_event.is_set():
+                self.update_event.clear()
+
+                for client, (upload, download) in self.updater.update().items():
+                    self.timeline.append((now - self.start, client._client_config.url, upload, download))
+
+            if now >= self.end:
+                break
+
+            next_time = min(
+                self.start + events[event_index]["at"] if event_index < len(events) else self.end,
+                *next_poll.values(),
+                *next_schedule.values(),
+                next_data_cap,
+                self.end,
+            )
+
+            if self.uplink_usage() > self.uplink:
+                self.oversubscribed_seconds += next_time - now
+
+            for client in self.clients.values():
+                client.transfer(next_time - now)
+
+            self.clock.advance_to(next_time)
+
+        return {
+            "duration": self.end - self.start,
+            "client_writes": sum(client.writes for client in self.clients.values()),
+            "transferred": [sum(client.transferred[direction] for client in self.clients.values()) for direction in (0, 1)],
+            "oversubscribed_seconds": self.oversubscribed_seconds,
+            "timeline": self.timeline,
+        }
+
+
+
+if __name__ == '__main__':
+    args = arguments.load_simulation_args()
+
+    log_loader.set_stdout_level(args.log_level)
+
+    if not args.config:
+        logger.critical("No config file specified, use --config_path arg or SPEEDRR_CONFIG env var to specify a config file.")
+        exit()
+
+    if not args.trace and args.synthetic is None:
+        logger.critical("No trace specified, use --trace to replay a trace file, or --synthetic to generate one.")
+        exit()
+
+    cfg = config.load_config(args.config)
+    trace = load_trace(args.trace) if args.trace else generate_trace(cfg, args.synthetic, args.seed)
+
+    for pool_name, pool_cfg in config.pool_configs(cfg):
+        wall_start = time.perf_counter()
+        report = Simulation(pool_cfg, trace, pool_name).run()
+        wall_time = time.perf_counter() - wall_start
+
+        if pool_name:
+            print(f"Pool: {pool_name}")
+        print(f"Simulated {timedelta(seconds=int(report['duration']))} in {wall_time:.2f}s")
+        print(f"Client writes: {report['client_writes']}")
+        print(f"Transferred: {bit_conv(report['transferred'][0], 'B', 'GB'):.1f}GB upload, {bit_conv(report['transferred'][1], 'B', 'GB'):.1f}GB download")
+        print(f"Uplink oversubscribed for {timedelta(seconds=int(report['oversubscribed_seconds']))} ({report['oversubscribed_seconds'] / report['duration']:.1%})")
+        print("Limit timeline:")
+        for offset, url, upload, download in report["timeline"]:
+            print(f"  +{timedelta(seconds=int(offset))}  {url}  upload={upload:.3f}{cfg.units}  download={download:.3f}{cfg.units}")
+        print()
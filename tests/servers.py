@@ -0,0 +1,24 @@
+import threading
+from typing import List
+
+from helpers.config import SpeedrrConfig, ModulesConfig, MediaServerConfig, IgnoreStreamConfig, StreamRuleConfig
+from modules.media_server import BaseServer, MediaServerModule
+
+
+
+def load_server(
+    rules: List[StreamRuleConfig],
+    bandwidth_multiplier: float = 1.0,
+    ignore_streams: IgnoreStreamConfig = IgnoreStreamConfig(local=False, ip_networks=None, paused_after=-1),
+) -> BaseServer:
+    "A Plex server that is never polled, to call `process_session` on directly. The config uses Mbit."
+
+    config = SpeedrrConfig(
+        logs_path=None, units="Mbit", min_upload=1, max_upload=100, min_download=1, max_download=100, clients=[],
+        modules=ModulesConfig(media_servers=None, schedule=None, stream_rules=rules),
+    )
+    server_config = MediaServerConfig(
+        type="plex", url="http://127.0.0.1", https_verify=False, bandwidth_multiplier=bandwidth_multiplier,
+        update_interval=5, ignore_streams=ignore_streams,
+    )
+    return BaseServer(config, server_config, MediaServerModule(config, [], threading.Event()))
@@ -0,0 +1,94 @@
+import math
+import random
+
+import pytest
+
+from helpers.allocator import allocate
+
+
+
+def random_case(rng: random.Random) -> tuple[float, list[float], list[float], list]:
+    count = rng.randint(1, 30)
+    weights = [rng.choice([0, 0, rng.randint(1, 50), rng.random() * 10]) for _ in range(count)]
+    floors = [rng.choice([0, rng.random() * 20]) for _ in range(count)]
+    ceilings = [rng.choice([None, floor + rng.random() * 100]) for floor in floors]
+    total = rng.random() * 40 * count
+    return total, weights, floors, ceilings
+
+
+cases = [random_case(random.Random(seed)) for seed in range(2000)]
+
+
+@pytest.mark.parametrize("total, weights, floors, ceilings", cases)
+def test_properties(total: float, weights: list[float], floors: list[float], ceilings: list) -> None:
+    speeds = allocate(total, weights, floors, ceilings)
+    assert len(speeds) == len(weights)
+
+    sum_floors = sum(floors)
+    if sum_floors >= total:
+        # Floors are scaled down to fit
+        assert speeds == pytest.approx([floor * total / sum_floors for floor in floors] if sum_floors else [0] * len(floors))
+        return
+
+    ceiling_values = [math.inf if ceiling is None else ceiling for ceiling in ceilings]
+
+    for speed, weight, floor, ceiling in zip(speeds, weights, floors, ceiling_values):
+        assert floor - 1e-9 <= speed <= ceiling + 1e-9
+
+        if weight <= 0:
+            assert speed == floor
+
+    # The most the clients can get, weighted clients up to their ceiling, the rest at their floor
+    most = sum(ceiling if weight > 0 else floor for weight, floor, ceiling in zip(weights, floors, ceiling_values))
+    assert sum(speeds) == pytest.approx(min(total, most))
+
+    # Every client that isn't held at its floor or ceiling gets the same speed per weight
+    levels = [
+        speed / weight
+        for speed, weight, floor, ceiling in zip(speeds, weights, floors, ceiling_values)
+        if weight > 0 and floor + 1e-9 < speed < ceiling - 1e-9
+    ]
+    if levels:
+        assert max(levels) == pytest.approx(min(levels))
+
+
+@pytest.mark.parametrize("seed", range(500))
+def test_lone_client_gets_total(seed: int) -> None:
+    rng = random.Random(seed)
+    total = rng.choice([rng.randint(1, 1000), rng.random() * 1000])
+    weight = rng.choice([rng.randint(1, 100), rng.random() * 50])
+    idle = rng.randint(0, 5)
+
+    # Exactly, a share above `total` would be above the max speed
+    assert allocate(total, [weight]) == [total]
+    assert allocate(total, [0] * idle + [weight], [0] * (idle + 1), [None] * (idle + 1))[-1] == total
+
+
+def test_split_by_weight() -> None:
+    assert allocate(30, [1, 2]) == pytest.approx([10, 20])
+
+
+def test_ceiling_shared_with_others() -> None:
+    assert allocate(30, [1, 1, 1], None, [2, None, None]) == pytest.approx([2, 14, 14])
+
+
+def test_floor_taken_from_others() -> None:
+    assert allocate(30, [1, 1], [20, 0]) == pytest.approx([20, 10])
+
+
+def test_floors_scaled_down() -> None:
+    assert allocate(10, [1, 1], [10, 30]) == pytest.approx([2.5, 7.5])
+
+
+def test_every_weighted_client_at_ceiling() -> None:
+    assert allocate(100, [1, 3], None, [10, 20]) == pytest.approx([10, 20])
+
+
+def test_zero_weight_gets_floor() -> None:
+    # Both when the weighted clients share the total, and when they are all held at their ceiling
+    assert allocate(30, [0, 1], [5, 0], [50, None]) == pytest.approx([5, 25])
+    assert allocate(100, [0, 1], [5, 0], [50, 10]) == pytest.approx([5, 10])
+
+
+def test_no_clients() -> None:
+    assert allocate(10, []) == []
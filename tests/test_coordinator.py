@@ -0,0 +1,150 @@
+import socket
+import threading
+from pathlib import Path
+from typing import Iterator, Optional
+
+import pytest
+
+from helpers.clock import VirtualClock
+from helpers.config import SpeedrrConfig, CoordinatorConfig
+from helpers.coordinator import AuthorityCoordinator, MemberCoordinator
+
+
+
+config = SpeedrrConfig(logs_path=None, units="B", min_upload=1, max_upload=90, min_download=1, max_download=300, clients=[])
+
+
+class Uplink:
+    "An authority answering members on an ephemeral TCP port or a Unix socket, all on one virtual clock."
+
+    def __init__(self, address: str, secret: Optional[str] = None) -> None:
+        self.clock = VirtualClock(1000)
+        self.secret = secret
+        self.authority = AuthorityCoordinator(config, self.coordinator_config("authority", address), threading.Event(), self.clock)
+        self.authority.serve()
+
+        server_address = self.authority._server.server_address # type: ignore
+        self.address = address if address.startswith("unix:") else f"127.0.0.1:{server_address[1]}"
+
+
+    def coordinator_config(self, name: str, address: str, secret: Optional[str] = None) -> CoordinatorConfig:
+        return CoordinatorConfig(
+            role="authority" if name == "authority" else "member", address=address, name=name,
+            lease=30, fallback_upload=2, fallback_download=5, secret=secret or self.secret,
+        )
+
+
+    def member(self, name: str, secret: Optional[str] = None) -> MemberCoordinator:
+        return MemberCoordinator(config, self.coordinator_config(name, self.address, secret), threading.Event(), self.clock)
+
+
+    def granted(self) -> tuple[float, float]:
+        "The slices given out, added up."
+        return (
+            sum(upload for upload, _ in self.authority._granted.values()),
+            sum(download for _, download in self.authority._granted.values()),
+        )
+
+
+    def close(self) -> None:
+        assert self.authority._server is not None
+        self.authority._server.shutdown()
+        self.authority._server.server_close()
+
+
+addresses = ["127.0.0.1:0"]
+if hasattr(socket, "AF_UNIX"):
+    addresses.append("unix")
+
+
+@pytest.fixture(params=addresses)
+def uplink(request: pytest.FixtureRequest, tmp_path: Path) -> Iterator[Uplink]:
+    uplink = Uplink(f"unix:{tmp_path / 'coordinator.sock'}" if request.param == "unix" else request.param)
+    yield uplink
+    uplink.close()
+
+
+def test_slices_shared(uplink: Uplink) -> None:
+    authority = uplink.authority
+    assert authority.get_slice() == (90, 300)
+
+    first = uplink.member("first")
+    first.renew()
+    assert first.get_slice() == authority.get_slice() == (45, 150)
+
+
+def test_joining_member_waits_for_others_to_renew(uplink: Uplink) -> None:
+    authority = uplink.authority
+    authority.get_slice()
+    first = uplink.member("first")
+    first.renew()
+
+    # The first member holds half until it renews, so the new one only gets what's left
+    second = uplink.member("second")
+    second.renew()
+    assert authority.get_slice() == (30, 100)
+    assert first.get_slice() == (45, 150)
+    assert second.get_slice() == (15, 50)
+    assert uplink.granted() == (90, 300)
+
+    first.renew()
+    second.renew()
+    assert first.get_slice() == second.get_slice() == authority.get_slice() == (30, 100)
+    assert uplink.granted() == (90, 300)
+
+
+def test_demand_left_to_others(uplink: Uplink) -> None:
+    authority = uplink.authority
+    authority.get_slice()
+    first = uplink.member("first")
+    first.renew()
+
+    # The authority needs less, which the member gets once it renews
+    authority.set_demand(10, 300)
+    assert authority.get_slice() == (10, 150)
+
+    first.renew()
+    assert first.get_slice() == (80, 150)
+    assert uplink.granted() == (90, 300)
+
+
+def test_name_conflicts_rejected(uplink: Uplink) -> None:
+    uplink.member("first").renew()
+
+    with pytest.raises(Exception, match="already has a lease"):
+        uplink.member("first").renew()
+
+    with pytest.raises(Exception, match="authority's name"):
+        uplink.member("authority").renew()
+
+
+def test_secret() -> None:
+    uplink = Uplink("127.0.0.1:0", secret="secret")
+
+    try:
+        with pytest.raises(Exception, match="Wrong secret"):
+            uplink.member("first", secret="wrong").renew()
+
+        uplink.authority.get_slice()
+        member = uplink.member("first")
+        member.renew()
+        assert member.get_slice() == (45, 150)
+
+    finally:
+        uplink.close()
+
+
+def test_lease_expiry(uplink: Uplink) -> None:
+    authority = uplink.authority
+    authority.get_slice()
+    first = uplink.member("first")
+    first.renew()
+
+    # Without renewing, the member falls back once its lease runs out
+    uplink.clock.advance_to(1031)
+    assert first.get_slice() == (2, 5)
+
+    # And the authority takes its slice back
+    authority.renew()
+    assert authority.get_slice() == (90, 300)
+    assert "first" not in authority._granted
@@ -0,0 +1,165 @@
+import json
+import threading
+from datetime import datetime
+from pathlib import Path
+
+import pytest
+
+from helpers.clock import VirtualClock
+from helpers.config import SpeedrrConfig, ClientConfig, DataCapConfig
+from helpers.updater import SpeedUpdater
+from modules.data_cap import DataCapModule
+
+
+
+class FakeClient:
+    "A torrent client whose transfer counters are set directly, and that records the limits written to it."
+
+    def __init__(self, url: str = "http://a") -> None:
+        self._client_config = ClientConfig(type="qbittorrent", url=url, username="", password="", https_verify=False)
+        self.counters = (0, 0)
+        self.limits: dict[str, float] = {}
+
+
+    def get_transferred_bytes(self) -> tuple[int, int]:
+        return self.counters
+
+
+    def get_active_torrent_count(self) -> int:
+        return 1
+
+
+    def set_upload_speed(self, speed: float) -> None:
+        self.limits["upload"] = speed
+
+
+    def set_download_speed(self, speed: float) -> None:
+        self.limits["download"] = speed
+
+
+
+# January has 31 days, so a cap of 2678400000B is a pace of exactly 1000B/s for the whole period
+START = datetime(2026, 1, 1).timestamp()
+PERIOD = 31 * 24 * 60 * 60
+CAP = PERIOD * 1000
+
+config = SpeedrrConfig(logs_path=None, units="B", min_upload=5000, max_upload=100000, min_download=5000, max_download=100000, clients=[])
+
+
+def load_module(tmp_path: Path, clients: list[FakeClient], clock: VirtualClock, burst: float = 0) -> DataCapModule:
+    module_config = DataCapConfig(state_path=str(tmp_path / "data_cap.json"), upload_cap=CAP, cap_units="B", burst=burst, margin=0, update_interval=60)
+    return DataCapModule(config, module_config, threading.Event(), clients, clock) # type: ignore
+
+
+def test_paced_to_use_cap_by_period_end(tmp_path: Path) -> None:
+    module = load_module(tmp_path, [FakeClient()], VirtualClock(START))
+    module.update()
+
+    assert module.get_speed_cap() == (1000, float("inf"))
+
+
+def test_token_bucket(tmp_path: Path) -> None:
+    client = FakeClient()
+    clock = VirtualClock(START)
+    module = load_module(tmp_path, [client], clock, burst=1)
+    burst = CAP / 100
+
+    # The full bucket can be emptied over the next interval, on top of the pace
+    module.update()
+    assert module.get_speed_cap()[0] == pytest.approx(1000 + burst / 60)
+
+    # Using the pace and the whole bucket leaves only the pace
+    clock.advance_to(START + 60)
+    client.counters = (int(60 * 1000 + burst), 0)
+    module.update()
+    assert module._tokens[0] == 0
+    assert module.get_speed_cap()[0] == pytest.approx((CAP - 60 * 1000 - burst) / (PERIOD - 60), abs=0.001)
+
+    # Idle time refills it at the pace
+    clock.advance_to(START + 660)
+    module.update()
+    assert module._tokens[0] == pytest.approx((CAP - 60 * 1000 - burst) / (PERIOD - 660) * 600)
+
+
+def test_counters_reset_by_restart(tmp_path: Path) -> None:
+    client = FakeClient()
+    clock = VirtualClock(START)
+    module = load_module(tmp_path, [client], clock)
+
+    # Counted from the first time the client is seen
+    client.counters = (1000, 0)
+    module.update()
+    assert module._used == [0, 0]
+
+    client.counters = (5000, 0)
+    clock.advance_to(START + 60)
+    module.update()
+    assert module._used == [4000, 0]
+
+    # Restarted, so everything since the restart is new
+    client.counters = (200, 0)
+    clock.advance_to(START + 120)
+    module.update()
+    assert module._used == [4200, 0]
+
+
+def test_state_reloaded(tmp_path: Path) -> None:
+    client = FakeClient()
+    clock = VirtualClock(START)
+    module = load_module(tmp_path, [client], clock)
+    module.update()
+
+    client.counters = (5000, 0)
+    clock.advance_to(START + 60)
+    module.update()
+
+    reloaded = load_module(tmp_path, [client], clock)
+    assert reloaded._used == [5000, 0]
+
+    # The client's counters are kept too, so nothing is counted twice
+    client.counters = (6000, 0)
+    clock.advance_to(START + 120)
+    reloaded.update()
+    assert reloaded._used == [6000, 0]
+
+
+def test_state_from_previous_period_ignored(tmp_path: Path) -> None:
+    (tmp_path / "data_cap.json").write_text(json.dumps({
+        "period_start": datetime(2025, 12, 1).timestamp(),
+        "used": [CAP, 0],
+        "tokens": [0, 0],
+        "last_counters": {},
+    }))
+
+    module = load_module(tmp_path, [FakeClient()], VirtualClock(START))
+    assert module._used == [0, 0]
+
+
+def test_period_rollover(tmp_path: Path) -> None:
+    client = FakeClient()
+    clock = VirtualClock(START)
+    module = load_module(tmp_path, [client], clock)
+    module.update()
+
+    # The whole cap used up, so nothing is allowed until the next period
+    client.counters = (CAP, 0)
+    clock.advance_to(START + 60)
+    module.update()
+    assert module.get_speed_cap()[0] == 0
+
+    clock.advance_to(START + PERIOD)
+    module.update()
+    assert module._used == [0, 0]
+    assert module._period_start == START + PERIOD
+    assert module.get_speed_cap()[0] == pytest.approx(CAP / (28 * 24 * 60 * 60), abs=0.001)
+
+
+def test_cap_wins_over_min_speeds(tmp_path: Path) -> None:
+    client = FakeClient()
+    clock = VirtualClock(START)
+    module = load_module(tmp_path, [client], clock)
+    module.update()
+
+    # min_upload is 5000B/s, above the pace of 1000B/s
+    SpeedUpdater(config, [module], [client], clock).update()
+    assert client.limits == {"upload": 1000, "download": 100000}
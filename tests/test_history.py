@@ -0,0 +1,88 @@
+from typing import Iterator
+
+import pytest
+
+from helpers.config import HistoryConfig, HistoryTierConfig
+from helpers.history import TimeSeries, history, query_server, start_server
+
+
+
+def series(*tiers: tuple[int, int]) -> TimeSeries:
+    return TimeSeries(tuple(HistoryTierConfig(resolution=resolution, duration=duration) for resolution, duration in tiers))
+
+
+def test_query_uses_finest_tier() -> None:
+    samples = series((1, 10), (10, 100))
+    for timestamp in range(1000, 1030):
+        samples.record(timestamp, timestamp)
+
+    # The last 10 seconds (and the open bucket) every second, averaged every 10 seconds before that
+    assert samples.query(0, 2000) == [
+        (1000, 1004.5),
+        (1010, 1014.5),
+        *((timestamp, timestamp) for timestamp in range(1019, 1030)),
+    ]
+
+
+def test_query_range() -> None:
+    samples = series((1, 10), (10, 100))
+    for timestamp in range(1000, 1030):
+        samples.record(timestamp, timestamp)
+
+    assert samples.query(1010, 1021) == [(1010, 1014.5), (1019, 1019), (1020, 1020), (1021, 1021)]
+    assert samples.query(2000, 3000) == []
+
+
+def test_older_data_from_coarser_tier() -> None:
+    samples = series((10, 20), (100, 1000))
+    for timestamp in range(1000, 1100, 5):
+        samples.record(timestamp, 1)
+
+    # Only two closed 10 second buckets are kept, before them it's the open 100 second bucket
+    assert [timestamp for timestamp, _ in samples.query(0, 2000)] == [1000, 1070, 1080, 1090]
+
+
+def test_value_at_is_a_raw_sample() -> None:
+    samples = series((10, 100), (60, 600))
+    samples.record(1000, 1)
+    samples.record(1005, 5)
+
+    # Not the average of the open bucket, or a sample recorded later
+    assert samples.value_at(1003) == 1
+    assert samples.value_at(1005) == 5
+    assert samples.value_at(1100) == 5
+    assert samples.value_at(999) is None
+
+
+def test_value_at_before_raw_samples() -> None:
+    samples = series((1, 5), (10, 100))
+    for timestamp in range(1000, 1030):
+        samples.record(timestamp, timestamp)
+
+    # Only the last 5 raw samples are kept, before them it's the last sample of a bucket closed by then
+    assert samples.value_at(1026) == 1026
+    assert samples.value_at(1012.5) == 1009
+    assert samples.value_at(1020) == 1019
+
+
+
+@pytest.fixture
+def served() -> Iterator[HistoryConfig]:
+    server = start_server(HistoryConfig(port=0))
+    history.configure(HistoryConfig())
+
+    yield HistoryConfig(port=server.server_address[1])
+
+    server.shutdown()
+    server.server_close()
+    history.enabled = False
+    history.series.clear()
+
+
+def test_query_server(served: HistoryConfig) -> None:
+    history.record("target.upload", 10, 1000)
+    history.record("target.upload", 20, 1001)
+
+    assert query_server(served, "list", None) == {"series": ["target.upload"]}
+    assert query_server(served, "target.upload", "1000.5") == {"series": "target.upload", "value": 10}
+    assert query_server(served, "unknown", None) == {"error": "Unknown series: unknown"}
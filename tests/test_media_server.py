@@ -0,0 +1,214 @@
+import json
+import threading
+import urllib.parse
+from dataclasses import replace
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterator, Optional
+
+import pytest
+
+from helpers.clock import VirtualClock
+from helpers.config import SpeedrrConfig, MediaServerConfig, IgnoreStreamConfig
+from helpers.reduction_store import ReductionStore
+from modules.media_server import MediaServerModule, PlexServer, SessionIndex
+
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    "A stand-in for the Plex API, answering with the sessions and bandwidth statistics set on the server."
+
+    server: "StandInServer"
+
+    def do_GET(self) -> None:
+        url = urllib.parse.urlparse(self.path)
+        params = urllib.parse.parse_qs(url.query)
+        self.server.requests.append(url.path)
+
+        if params.get("X-Plex-Token") != ["token"]:
+            self.send_json(401, {"error": "Unauthorized"})
+
+        elif url.path == "/status/sessions":
+            self.send_json(200, {"MediaContainer": {"size": len(self.server.sessions), "Metadata": self.server.sessions}})
+
+        elif url.path == "/statistics/bandwidth" and self.server.statistics is not None:
+            self.send_json(200, {"MediaContainer": {"Device": self.server.devices, "StatisticsBandwidth": self.server.statistics}})
+
+        else:
+            self.send_json(404, {"error": "Not found"})
+
+
+    def send_json(self, status: int, body: dict) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+
+class StandInServer(ThreadingHTTPServer):
+    def __init__(self) -> None:
+        super().__init__(("127.0.0.1", 0), StandInHandler)
+        self.sessions: list[dict] = []
+        self.devices: list[dict] = []
+        # `None` answers the statistics with a 404, like a server without them
+        self.statistics: Optional[list[dict]] = []
+        self.requests: list[str] = []
+
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+    def add_session(self, session_id: str, player_id: str, bandwidth: int) -> None:
+        self.sessions.append({
+            "title": session_id,
+            "ratingKey": "1",
+            "Session": {"id": session_id, "bandwidth": bandwidth},
+            "Player": {"machineIdentifier": player_id, "state": "playing", "address": "1.1.1.1", "title": player_id},
+        })
+
+
+    def add_statistics(self, device_id: int, player_id: str, at: list[int], bytes_each: int) -> None:
+        self.devices.append({"id": device_id, "clientIdentifier": player_id})
+        self.statistics = (self.statistics or []) + [{"deviceID": device_id, "at": timestamp, "bytes": bytes_each} for timestamp in at]
+
+
+
+@pytest.fixture
+def stand_in() -> Iterator[StandInServer]:
+    server = StandInServer()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    yield server
+
+    server.shutdown()
+    server.server_close()
+
+
+config = SpeedrrConfig(logs_path=None, units="Kbit", min_upload=1, max_upload=100000, min_download=1, max_download=100000, clients=[])
+
+
+def server_config(url: str, bandwidth_mode: str = "measured") -> MediaServerConfig:
+    return MediaServerConfig(
+        type="plex", url=url, https_verify=False, bandwidth_multiplier=1.0, update_interval=5, token="token",
+        ignore_streams=IgnoreStreamConfig(local=False, ip_networks=None, paused_after=-1), bandwidth_mode=bandwidth_mode, # type: ignore
+    )
+
+
+def load_server(stand_in: StandInServer, bandwidth_mode: str = "measured") -> tuple[PlexServer, MediaServerModule, VirtualClock]:
+    clock = VirtualClock(1000)
+    module = MediaServerModule(config, [server_config(stand_in.url, bandwidth_mode)], threading.Event(), clock)
+    server = module.servers[0]
+    assert isinstance(server, PlexServer)
+    return server, module, clock
+
+
+def poll_after(server: PlexServer, clock: VirtualClock, seconds: float) -> None:
+    clock.advance_to(clock.time() + seconds)
+    server.poll()
+
+
+def test_statistics_mapped_to_players(stand_in: StandInServer) -> None:
+    stand_in.add_session("a", "player-a", 8000)
+    stand_in.add_session("b", "player-b", 6000)
+
+    # 750000B over the 30s window is 200Kbit/s, the entry at 95 is outside it
+    stand_in.add_statistics(5, "player-a", [95, 110, 120, 130], 250000)
+    stand_in.add_statistics(9, "player-b", [125], 375000)
+
+    server, module, clock = load_server(stand_in)
+    poll_after(server, clock, 31)
+
+    assert module.get_reduction_value() == (200 + 100, 0)
+
+
+def test_new_session_uses_reserved(stand_in: StandInServer) -> None:
+    stand_in.add_session("a", "player-a", 8000)
+    stand_in.add_statistics(5, "player-a", [110, 120, 130], 250000)
+
+    server, module, clock = load_server(stand_in)
+
+    poll_after(server, clock, 29)
+    assert module.get_reduction_value() == (8000, 0)
+
+    poll_after(server, clock, 2)
+    assert module.get_reduction_value() == (200, 0)
+
+    # A session starting later waits for its own window
+    stand_in.add_session("b", "player-b", 6000)
+    stand_in.add_statistics(9, "player-b", [130], 375000)
+    poll_after(server, clock, 1)
+    assert module.get_reduction_value() == (200 + 6000, 0)
+
+
+def test_player_without_statistics_uses_reserved(stand_in: StandInServer) -> None:
+    stand_in.add_session("a", "player-a", 8000)
+    stand_in.add_statistics(5, "player-other", [110, 120, 130], 250000)
+
+    server, module, clock = load_server(stand_in)
+    poll_after(server, clock, 31)
+
+    assert module.get_reduction_value() == (8000, 0)
+
+
+def test_sessions_on_one_player_split_it(stand_in: StandInServer) -> None:
+    stand_in.add_session("a", "player-a", 8000)
+    stand_in.add_session("b", "player-a", 8000)
+    stand_in.sessions[1]["ratingKey"] = "2"
+    stand_in.add_statistics(5, "player-a", [110, 120, 130], 250000)
+
+    server, module, clock = load_server(stand_in)
+    poll_after(server, clock, 31)
+
+    assert module.get_reduction_value() == (200, 0)
+
+
+def test_statistics_error_uses_reserved(stand_in: StandInServer) -> None:
+    stand_in.statistics = None
+    server, module, clock = load_server(stand_in)
+
+    # Startup has no sessions, so it doesn't ask for the statistics
+    stand_in.add_session("a", "player-a", 8000)
+    poll_after(server, clock, 31)
+
+    assert "/statistics/bandwidth" in stand_in.requests
+    assert module.get_reduction_value() == (8000, 0)
+
+
+def test_reserved_mode_skips_statistics(stand_in: StandInServer) -> None:
+    stand_in.add_session("a", "player-a", 8000)
+    stand_in.add_statistics(5, "player-a", [110, 120, 130], 250000)
+
+    server, module, clock = load_server(stand_in, "reserved")
+    poll_after(server, clock, 31)
+
+    assert "/statistics/bandwidth" not in stand_in.requests
+    assert module.get_reduction_value() == (8000, 0)
+
+
+def test_session_index_prefers_measured() -> None:
+    store = ReductionStore()
+    index = SessionIndex(store)
+
+    plex = server_config("http://plex")
+    tautulli = replace(server_config("http://tautulli", "reserved"), type="tautulli")
+    identity = ("1.1.1.1", "player-a", "1")
+
+    index.publish(tautulli, {identity: 8000})
+    index.publish(plex, {identity: 200})
+    assert store.snapshot.upload == 200
+    assert store.snapshot.values[plex] == (200, 0)
+
+    # Between servers in the same mode, the highest bandwidth is counted
+    index.publish(plex, {})
+    index.publish(replace(plex, url="http://plex2", bandwidth_mode="reserved"), {identity: 9000})
+    assert store.snapshot.upload == 9000
@@ -0,0 +1,64 @@
+import pytest
+
+from helpers.config import StreamRuleConfig
+from helpers.stream_rules import StreamPolicy
+from tests.servers import load_server
+
+
+
+def decide(rules: list[StreamRuleConfig], user: str = "", player: str = "", library: str = "", transcode: bool = False, server_type: str = "plex"):
+    return StreamPolicy(rules, "Mbit").decide(server_type, user, player, library, transcode)
+
+
+def test_first_match_wins() -> None:
+    rules = [
+        StreamRuleConfig(action="ignore", user="bob"),
+        StreamRuleConfig(action="multiply", value=0.5),
+        StreamRuleConfig(action="ignore"),
+    ]
+
+    assert decide(rules, user="alice") == (1, "multiply", 0.5)
+    assert decide(rules, user="bob") == (0, "ignore", 0)
+
+
+def test_no_match() -> None:
+    rules = [StreamRuleConfig(action="ignore", user="bob", transcode=True)]
+
+    assert decide(rules, user="bob") is None
+    assert decide(rules, user="alice", transcode=True) is None
+    assert decide([], user="bob") is None
+
+
+def test_cap_in_kbit() -> None:
+    assert decide([StreamRuleConfig(action="cap", value=2)]) == (0, "cap", 2000)
+
+
+@pytest.mark.parametrize("condition, value", [
+    ("Living Room TV", "living room tv"),
+    ("living room tv ", "Living Room TV"),
+    ("Living Room TV", " LIVING ROOM TV "),
+])
+def test_matched_after_normalizing(condition: str, value: str) -> None:
+    rules = [StreamRuleConfig(action="ignore", player=condition)]
+
+    assert decide(rules, player=value) is not None
+
+
+@pytest.mark.parametrize("bandwidth, multiplier, counted", [
+    (8000, 2.0, 5000),
+    (8000, 0.5, 4000),
+    (4000, 1.0, 4000),
+])
+def test_cap_after_multiplier(bandwidth: int, multiplier: float, counted: int) -> None:
+    server = load_server([StreamRuleConfig(action="cap", value=5)], multiplier)
+
+    assert server.process_session(bandwidth, False, "1.1.1.1", "session", "title") == counted
+
+    server.set_reduction()
+    assert server._module.get_reduction_value() == (counted / 1000, 0)
+
+
+def test_multiply_on_top_of_multiplier() -> None:
+    server = load_server([StreamRuleConfig(action="multiply", value=0.5, user="alice")], 0.8)
+
+    assert server.process_session(10000, False, "1.1.1.1", "session", "title", user="Alice ") == 4000
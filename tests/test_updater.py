@@ -0,0 +1,103 @@
+from helpers.config import SpeedrrConfig, ClientConfig
+from helpers.reduction_store import ReductionStore
+from helpers.updater import SpeedUpdater
+
+
+
+class FakeClient:
+    "A torrent client that records the limits written to it."
+
+    def __init__(self, url: str, active: int = 1) -> None:
+        self._client_config = ClientConfig(type="qbittorrent", url=url, username="", password="", https_verify=False)
+        self.active = active
+        self.writes: list[tuple[str, float]] = []
+
+
+    def get_active_torrent_count(self) -> int:
+        return self.active
+
+
+    def set_upload_speed(self, speed: float) -> None:
+        self.writes.append(("upload", speed))
+
+
+    def set_download_speed(self, speed: float) -> None:
+        self.writes.append(("download", speed))
+
+
+
+class FakeModule:
+    "A module whose reduction is set directly."
+
+    def __init__(self) -> None:
+        self.reduction_store = ReductionStore()
+
+
+    def reduce(self, upload: float, download: float) -> None:
+        self.reduction_store.publish({self: (upload, download)})
+
+
+    def get_reduction_value(self) -> tuple[float, float]:
+        snapshot = self.reduction_store.snapshot
+        return snapshot.upload, snapshot.download
+
+
+
+config = SpeedrrConfig(logs_path=None, units="Mbit", min_upload=1, max_upload=60, min_download=1, max_download=8, clients=[])
+
+
+def test_unchanged_target_not_written() -> None:
+    client = FakeClient("http://a", active=1)
+    updater = SpeedUpdater(config, [], [client])
+
+    assert updater.update() == {client: (60, 8)}
+    assert len(client.writes) == 2
+
+    # The split of the same target by a different weight is an ulp off, e.g. 59.99999999999999
+    for active in (11, 3, 7, 1):
+        client.active = active
+        assert updater.update() == {}
+
+    assert len(client.writes) == 2
+
+
+def test_changed_target_written() -> None:
+    module = FakeModule()
+    client = FakeClient("http://a")
+    updater = SpeedUpdater(config, [module], [client])
+    updater.update()
+
+    module.reduce(10, 0)
+    assert updater.update() == {client: (50, 8)}
+    assert client.writes[-2:] == [("upload", 50), ("download", 8)]
+
+    module.reduce(10, 0)
+    assert updater.update() == {}
+
+
+def test_only_changed_clients_written() -> None:
+    first = FakeClient("http://a", active=1)
+    second = FakeClient("http://b", active=1)
+    idle = FakeClient("http://c", active=0)
+    updater = SpeedUpdater(config, [], [first, second, idle])
+    updater.update()
+
+    # Same split between the active clients, so nothing is written
+    first.active = second.active = 3
+    assert updater.update() == {}
+
+    # The idle client already has the whole speed
+    second.active = 0
+    assert updater.update() == {first: (60, 8), second: (60, 8)}
+    assert len(idle.writes) == 2
+
+
+def test_limits_whole_bytes() -> None:
+    client = FakeClient("http://a", active=3)
+    updater = SpeedUpdater(config, [], [client, FakeClient("http://b", active=4)])
+
+    upload, download = updater.update()[client]
+
+    # Whole B/s, i.e. multiples of 0.000008Mbit
+    assert round(upload * 125000) == upload * 125000
+    assert round(download * 125000) == download * 125000
@@ -0,0 +1,142 @@
+import json
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterator
+
+import pytest
+
+from helpers.config import SpeedrrConfig, UsenetConfig
+from modules.usenet import UsenetModule
+
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    "A stand-in for the SABnzbd and NZBGet APIs, answering with the queue state set on the server."
+
+    server: "StandInServer"
+
+    def do_GET(self) -> None:
+        url = urllib.parse.urlparse(self.path)
+        params = urllib.parse.parse_qs(url.query)
+
+        if url.path != "/api" or params.get("mode") != ["queue"] or params.get("apikey") != ["key"]:
+            self.send_json(404, {"error": "Not found"})
+            return
+
+        self.send_json(200, {"queue": {"paused": self.server.paused, "noofslots": self.server.slots}})
+
+
+    def do_POST(self) -> None:
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+
+        if self.path != "/jsonrpc" or body.get("method") != "status":
+            self.send_json(404, {"error": "Not found"})
+            return
+
+        self.send_json(200, {"result": {"DownloadPaused": self.server.paused, "RemainingSizeMB": self.server.slots * 700}})
+
+
+    def send_json(self, status: int, body: dict) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+
+class StandInServer(ThreadingHTTPServer):
+    def __init__(self) -> None:
+        super().__init__(("127.0.0.1", 0), StandInHandler)
+        self.paused = False
+        self.slots = 0
+
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+
+@pytest.fixture
+def stand_in() -> Iterator[StandInServer]:
+    server = StandInServer()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    yield server
+
+    server.shutdown()
+    server.server_close()
+
+
+config = SpeedrrConfig(logs_path=None, units="Mbit", min_upload=1, max_upload=10, min_download=1, max_download=200, clients=[])
+
+
+def load_module(stand_in: StandInServer, downloader_type: str, download: object = 40) -> tuple[UsenetModule, threading.Event]:
+    update_event = threading.Event()
+    downloader_config = UsenetConfig(type=downloader_type, url=stand_in.url, https_verify=False, download=download, api_key="key") # type: ignore
+    return UsenetModule(config, [downloader_config], update_event), update_event
+
+
+@pytest.mark.parametrize("downloader_type", ["sabnzbd", "nzbget"])
+@pytest.mark.parametrize("paused, slots, downloading", [
+    (False, 3, True),
+    (True, 3, False),
+    (False, 0, False),
+    (True, 0, False),
+])
+def test_is_downloading(stand_in: StandInServer, downloader_type: str, paused: bool, slots: int, downloading: bool) -> None:
+    stand_in.paused = paused
+    stand_in.slots = slots
+
+    module, _ = load_module(stand_in, downloader_type)
+
+    assert module.downloaders[0].is_downloading() == downloading
+
+
+@pytest.mark.parametrize("downloader_type", ["sabnzbd", "nzbget"])
+def test_released_after_queue_drains(stand_in: StandInServer, downloader_type: str) -> None:
+    module, update_event = load_module(stand_in, downloader_type)
+    downloader = module.downloaders[0]
+
+    downloader.poll()
+    assert module.get_reduction_value() == (0, 0)
+    assert not update_event.is_set()
+
+    stand_in.slots = 2
+    downloader.poll()
+    assert module.get_reduction_value() == (0, 40)
+    assert update_event.is_set()
+
+    update_event.clear()
+    stand_in.slots = 0
+    downloader.poll()
+    assert module.get_reduction_value() == (0, 0)
+    assert update_event.is_set()
+
+
+def test_percentage_of_max_download(stand_in: StandInServer) -> None:
+    stand_in.slots = 1
+    module, _ = load_module(stand_in, "sabnzbd", "25%")
+
+    module.downloaders[0].poll()
+    assert module.get_reduction_value() == (0, 50)
+
+
+def test_error_keeps_reduction(stand_in: StandInServer) -> None:
+    stand_in.slots = 1
+    module, _ = load_module(stand_in, "sabnzbd")
+    downloader = module.downloaders[0]
+    downloader.poll()
+
+    downloader._downloader_config = UsenetConfig(type="sabnzbd", url=stand_in.url, https_verify=False, download=40, api_key="wrong")
+    downloader.poll()
+    assert module.get_reduction_value() == (0, 40)